@@ -0,0 +1,52 @@
+'''
+Compares the JSON backends of emspy.serializer on payloads shaped like the API
+responses: a simple/async query page (rows of mixed numbers, strings, booleans and
+nulls) and a time-series query result (a few long arrays of floats).
+
+	python benchmarks/json_backend.py [n_rows]
+'''
+from __future__ import print_function
+import random, sys, timeit
+
+from emspy import serializer
+
+
+def query_page(n_rows, n_cols=12):
+
+	rnd = random.Random(0)
+	gens = [lambda: rnd.randint(0, 10**7), lambda: rnd.uniform(-1e4, 1e4),
+			lambda: rnd.choice(['KSEA', 'KLAX', 'EGLL', 'RJTT', None]),
+			lambda: rnd.random() < 0.5, lambda: '2018-03-%02dT%02d:13:07' % (rnd.randint(1, 28), rnd.randint(0, 23))]
+	cols = [gens[i % len(gens)] for i in range(n_cols)]
+	return {'header': [{'name': 'c%d' % i} for i in range(n_cols)],
+			'rows': [[g() for g in cols] for r in range(n_rows)]}
+
+
+def ts_result(n_rows, n_params=8):
+
+	rnd = random.Random(1)
+	return {'offsets': [i * 0.25 for i in range(n_rows)],
+			'results': [{'values': [rnd.gauss(0, 100) for i in range(n_rows)]} for p in range(n_params)]}
+
+
+def bench(payload, repeat=5):
+
+	res = dict()
+	body = serializer.dumps(payload, 'json')
+	for name in serializer.available_backends():
+		t_loads = min(timeit.repeat(lambda: serializer.loads(body, name), number=1, repeat=repeat))
+		t_dumps = min(timeit.repeat(lambda: serializer.dumps(payload, name), number=1, repeat=repeat))
+		res[name] = (t_loads, t_dumps)
+	return len(body), res
+
+
+if __name__ == '__main__':
+
+	n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 25000
+	for label, payload in (('query page', query_page(n_rows)), ('time series', ts_result(n_rows))):
+		size, res = bench(payload)
+		print("%s: %d rows, %.1f MB" % (label, n_rows, size / 2.0**20))
+		for name in sorted(res, key=lambda k: res[k][0]):
+			t_loads, t_dumps = res[name]
+			print("  %-7s loads %7.1f ms (x%4.1f)   dumps %7.1f ms (x%4.1f)" %
+				  (name, t_loads * 1e3, res['json'][0] / t_loads, t_dumps * 1e3, res['json'][1] / t_dumps))
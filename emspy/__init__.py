@@ -1,3 +1,7 @@
 from __future__ import absolute_import
 from .connection import Connection 
+
+import sys
+if sys.version_info >= (3, 5):
+	from .aioconnection import AsyncConnection
 # from query import *
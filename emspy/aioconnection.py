@@ -0,0 +1,63 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncConnection(object):
+	'''
+	Asyncio front end of a Connection. The awaitable request takes the same arguments
+	as Connection.request and goes through the same request building, authentication
+	and decoding. At most max_concurrency requests are in flight at a time, so one event
+	loop can drive hundreds of queries without flooding the API.
+
+	The requests themselves run on a thread pool sized to the concurrency limit, since
+	the HTTP layer of Connection is blocking urllib.
+	'''
+	def __init__(self, conn, max_concurrency=16):
+
+		self.conn 				= conn
+		self.max_concurrency 	= max_concurrency
+		self.__executor 		= ThreadPoolExecutor(max_workers=max_concurrency)
+		self.__sem 				= None
+
+
+	async def request(self, **kwargs):
+
+		return await self.call(functools.partial(self.conn.request, **kwargs))
+
+
+	async def call(self, func, *args):
+		'''
+		Runs a blocking function that sends requests, e.g. an async-query page read,
+		under the concurrency limit.
+		'''
+		# The semaphore has to be made inside the running event loop
+		if self.__sem is None:
+			self.__sem = asyncio.Semaphore(self.max_concurrency)
+		async with self.__sem:
+			return await self.run(func, *args)
+
+
+	async def run(self, func, *args):
+		'''
+		Runs a blocking function on the connection's thread pool, e.g. a DataFrame
+		conversion that may need metadata requests.
+		'''
+		loop = asyncio.get_event_loop()
+		return await loop.run_in_executor(self.__executor, func, *args)
+
+
+	def close(self):
+
+		self.__executor.shutdown(wait=False)
+
+
+	async def __aenter__(self):
+
+		return self
+
+
+	async def __aexit__(self, exc_type, exc_value, traceback):
+
+		self.close()
+		return False
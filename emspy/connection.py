@@ -5,10 +5,13 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import map
 from builtins import object
-import json, urllib.request, urllib.parse, urllib.error, urllib.request, urllib.error, urllib.parse, ssl, sys, io, gzip
+import urllib.request, urllib.parse, urllib.error, urllib.request, urllib.error, urllib.parse, ssl
+import threading, time, zlib
 from numbers import Number
 import pprint as pp
-from . import common
+from . import common, serializer
+from .scheduler import RequestScheduler
+from .httpcache import HttpCache
 
 
 
@@ -16,16 +19,34 @@ class Connection(object):
 	'''
 	Object for connection to EMS API
 	'''
-	def __init__(self, user=None, pwd=None, proxies=None, verbose=False, ignore_ssl_errors=False, server="prod", server_url=None):
+	# Bytes read from the socket at a time
+	chunk_size = 2**16
+
+	def __init__(self, user=None, pwd=None, proxies=None, verbose=False, ignore_ssl_errors=False, server="prod", server_url=None,
+				 token_margin=300, rate_limit=None, max_concurrency=16, max_retries=4, coalesce=True):
 
 		self.__user 		= user
 		self.__pwd  		= pwd
 		self.__proxies      = proxies
-		self.__ntrials      = 0
 		self.__uri_root     = None
 		self.__ignore_ssl_errors = ignore_ssl_errors
 		self.token 			= None
 		self.token_type 	= None
+		# The token is refreshed this many seconds before it expires, or half way
+		# through its lifetime if that is shorter
+		self.__token_margin = token_margin
+		self.__token_expiry = None
+		self.__token_life 	= None
+		self.__token_lock 	= threading.Lock()
+		# Rate limit (requests/sec), adaptive concurrency and retries of all the requests
+		self.scheduler 		= RequestScheduler(rate=rate_limit, max_concurrency=max_concurrency,
+											   max_retries=max_retries)
+		# Concurrent identical GET requests are sent once and share the decoded result
+		self.coalesce 		= coalesce
+		self.__inflight 	= dict()
+		self.__inflight_lock = threading.Lock()
+		# Opt-in on-disk cache of metadata GET responses. See enable_cache.
+		self.cache 			= None
 
 		# We assign the uri root to a member variable up front, and use that everywhere to
 		# simplify. In order to use an alternate uri root, it must be specified in the constructor.
@@ -55,35 +76,85 @@ class Connection(object):
 
 		resp_h, content = self.request(
 			rtype="POST", uri_keys=('sys','auth'), data=data, 
-			headers = headers, proxies=proxies, verbose=verbose
+			headers = headers, proxies=proxies, verbose=verbose, idempotent=True
 			)
 
-		# Add error handling --
+		if 'access_token' not in content:
+			raise ValueError("Authentication failed. Here is the message from API: %s" % content)
 
 		# Get the token
 		self.token      = content['access_token']
 		self.token_type = content['token_type']
+		self.__token_expiry = None
+		if 'expires_in' in content:
+			self.__token_life 	= float(content['expires_in'])
+			self.__token_expiry = time.time() + self.__token_life
 		return resp_h, content
 
 
 	def reconnect(self, verbose = False):
+		'''
+		Gets a new access token with the stored credentials.
+		'''
+		with self.__token_lock:
+			return self.connect(self.__user, self.__pwd, self.__proxies, verbose)
+
+
+	def token_expires_in(self):
+		'''
+		Seconds until the current access token expires, or None if unknown.
+		'''
+		if self.__token_expiry is None:
+			return None
+		return self.__token_expiry - time.time()
+
 
-		if self.__ntrials >= 3:
-			sys.exit("Stop trying to reconnect EMS API after %d trials" % self.__ntrials)
+	def __refresh_token(self, stale_token=None):
+		'''
+		Refreshes the access token if it is about to expire, or if it is still the given
+		stale token. Concurrent callers wait on the lock and then find the token already
+		refreshed, so only one of them sends the request.
+		'''
+		def stale():
+			if (stale_token is not None) and (self.token == stale_token):
+				return True
+			left = self.token_expires_in()
+			return (left is not None) and (left <= min(self.__token_margin, self.__token_life / 2))
 
-		self.__ntrials +=1
-		return self.connect(self.__user, self.__pwd, self.__proxies, verbose)
+		if self.__user is None or not stale():
+			return
+		with self.__token_lock:
+			if stale():
+				self.connect(self.__user, self.__pwd, self.__proxies)
 
 
 	def request(self,
 			rtype="GET", uri=None, uri_keys=None, uri_args=None, 
 			headers=None, body=None, data=None, jsondata=None, proxies=None, 
-			verbose=False
+			verbose=False, stream=False, raw=False, idempotent=None
 		):
-
-		# If no custom headers are given, use our own
-		if headers is None: 
-			headers = {'Authorization': ' '.join([self.token_type, self.token]), 'Accept-Encoding': 'gzip', 'User-Agent': common.user_agent }
+		'''
+		Sends a request to the EMS API and returns the response headers and the decoded
+		JSON content. With raw=True the content is returned as the (inflated) body bytes,
+		so that the caller can decode it its own way. With stream=True the content is
+		returned as a file-like object instead, which inflates the body while reading it
+		from the socket. Streamed requests bypass request coalescing and the HTTP cache,
+		and hold their scheduler slot until the body is read to the end or closed, so
+		close the stream when done with it.
+
+		JSON is encoded and decoded with the backend selected in emspy.serializer.
+
+		Failed requests are retried by the scheduler. POSTs are taken as not idempotent
+		and retried only when the server cannot have acted on them; pass idempotent=True
+		for POSTs that only read, e.g. queries.
+		'''
+		if idempotent is None:
+			idempotent = rtype != "POST"
+		# If no custom headers are given, use our own with the access token
+		auth = headers is None
+		if auth:
+			self.__refresh_token()
+			headers = self.__auth_headers()
 
 		# If uri_keys are given, find the uri from the uris dictionary
 		if uri_keys is not None:
@@ -117,35 +188,68 @@ class Connection(object):
 
 		if jsondata is not None:
 			headers['Content-Type'] = 'application/json'
-			data = json.dumps(jsondata).encode('utf-8')
+			data = serializer.dumps(jsondata)
 
 		# uri = uri.encode('utf-8')
-		req = urllib.request.Request(uri, data=data, headers=headers)
+		cache_key = None
+		if (self.cache is not None) and self.cache.covers(uri_keys) and rtype == "GET" and data is None:
+			cache_key = "%s %s" % (self.__user, uri)
+
+		# The scheduler tracks latency per endpoint
+		endpoint = tuple(uri_keys) if uri_keys is not None else None
+		if stream:
+			return self.__perform(rtype, uri, data, headers, auth, verbose, endpoint, idempotent, stream=True)
+		if self.coalesce and rtype == "GET" and data is None:
+			# Identical GETs in flight at the same time share one call
+			return self.__single_flight((uri, raw), lambda: self.__perform(rtype, uri, data, headers, auth, verbose, endpoint, idempotent, cache_key, raw=raw))
+		return self.__perform(rtype, uri, data, headers, auth, verbose, endpoint, idempotent, cache_key, raw=raw)
+
+
+	def __perform(self, rtype, uri, data, headers, auth, verbose, endpoint=None, idempotent=True, cache_key=None, stream=False, raw=False):
+
+		decode = (lambda b: b) if raw else serializer.loads
+		entry = None
+		if cache_key is not None:
+			entry = self.cache.get(cache_key)
+			if entry is not None:
+				if self.cache.is_fresh(entry):
+					return [], decode(entry['body'])
+				headers = dict(headers, **self.cache.validators(entry))
+
+		req = _make_request(rtype, uri, data, headers)
 		try:
-			resp = self.__send_request(req)
-			statcode = resp.getcode()
-			if statcode!=200:
-				print("Http status code: %d" % statcode)
-				verbose = True
-		except:
-			(eType, eValue, eTrace) = sys.exc_info()
-			if eType is ssl.CertificateError:
-				print("A certificate verification error occured for the request to '%s'. Certificate verification is required by default, but can be disabled by using the ignore_ssl_errors argument for the Connection constructor." % uri )
+			resp, body, release = self.__schedule(req, endpoint, idempotent, stream)
+		except urllib.error.HTTPError as e:
+			if e.code == 304 and entry is not None:
+				# Not modified. Serve the cached body.
+				self.cache.refresh(cache_key, e.headers)
+				return list(e.headers.items()), decode(entry['body'])
+			if not (auth and e.code == 401):
 				raise
+			# The token was revoked or expired early. Refresh it once and retry.
+			self.__refresh_token(stale_token=headers['Authorization'].split(' ', 1)[-1])
+			headers.update(self.__auth_headers())
+			req = _make_request(rtype, uri, data, headers)
+			resp, body, release = self.__schedule(req, endpoint, idempotent, stream)
+		except (ssl.CertificateError, urllib.error.URLError) as e:
+			if isinstance(e, ssl.CertificateError) or isinstance(getattr(e, 'reason', None), ssl.CertificateError):
+				print("A certificate verification error occured for the request to '%s'. Certificate verification is required by default, but can be disabled by using the ignore_ssl_errors argument for the Connection constructor." % uri )
+			raise
 
-			print("Trying to reconnect the EMS API.")
-			self.reconnect()
-			print("Done.")
-			resp = self.__send_request(req)
+		statcode = resp.getcode()
+		if statcode // 100 != 2:
+			print("Http status code: %d" % statcode)
+			verbose = True
 		resp_h   = resp.getheaders()
 
-		# If the response is compressed, decompress it.
-		if resp.info().get('Content-Encoding') == 'gzip':
-			buffer = io.BytesIO(resp.read())
-			file = gzip.GzipFile(fileobj=buffer)
-			content = json.loads(file.read())
-		else:
-			content = json.loads(resp.read())
+		if stream:
+			return resp_h, _BodyStream(resp, resp.info().get('Content-Encoding') == 'gzip', release)
+
+		# e.g. 204 No Content of a DELETE
+		content = decode(body) if (raw or len(body) > 0) else None
+
+		if cache_key is not None and len(body) > 0:
+			self.cache.put(cache_key, resp.info(), body)
 			
 		if verbose:
 			print("URL: %s" % resp.geturl())
@@ -155,6 +259,105 @@ class Connection(object):
 		return resp_h, content
 
 
+	def enable_cache(self, cache_file=None, max_bytes=200 * 2**20, uri_keys=None):
+		'''
+		Turns on the on-disk HTTP cache for GET responses.
+
+		Input
+		-----
+		cache_file: SQLite file of the cache. Default is httpCache.db in emspy/data.
+		max_bytes : max size of the stored (compressed) bodies. Least recently used
+					entries are evicted beyond it. Default is 200 MB.
+		uri_keys  : list of common.uris keys, e.g. [('fleet', 'list')], whose responses
+					are cached. Default is the metadata endpoints in httpcache.default_uri_keys.
+		'''
+		self.cache = HttpCache(cache_file, max_bytes, uri_keys)
+		return self.cache
+
+
+	def disable_cache(self):
+
+		if self.cache is not None:
+			self.cache.close()
+		self.cache = None
+
+
+	def __single_flight(self, key, perform):
+		'''
+		Runs perform() for the first caller of a key. Callers arriving with the same key
+		while it runs wait for it and get the same result (or exception). Note that the
+		decoded content is shared, not copied.
+		'''
+		with self.__inflight_lock:
+			call = self.__inflight.get(key)
+			leader = call is None
+			if leader:
+				call = _Call()
+				self.__inflight[key] = call
+
+		if not leader:
+			call.done.wait()
+			if call.error is not None:
+				raise call.error
+			return call.result
+
+		try:
+			call.result = perform()
+		except Exception as e:
+			call.error = e
+			raise
+		finally:
+			with self.__inflight_lock:
+				del self.__inflight[key]
+			call.done.set()
+		return call.result
+
+
+	def __auth_headers(self):
+
+		return {'Authorization': ' '.join([self.token_type, self.token]), 'Accept-Encoding': 'gzip', 'User-Agent': common.user_agent }
+
+
+	def get_uri_root(self):
+		'''
+		Returns the root uri of the EMS API server this connection talks to.
+		'''
+		return self.__uri_root
+
+
+	def get_user(self):
+		'''
+		Returns the user name this connection authenticates as, or None.
+		'''
+		return self.__user
+
+
+	def __schedule(self, req, endpoint, idempotent, stream):
+		'''
+		Sends the request through the scheduler. Returns the response, the body and, for
+		a streamed request, the function releasing its scheduler slot (None otherwise).
+		'''
+		send = lambda: self.__send_and_read(req, stream)
+		if stream:
+			(resp, body), release = self.scheduler.call(send, key=endpoint, idempotent=idempotent, hold=True)
+			return resp, body, release
+		resp, body = self.scheduler.call(send, key=endpoint, idempotent=idempotent)
+		return resp, body, None
+
+
+	def __send_and_read(self, req, stream=False):
+		'''
+		Sends the request and reads the body, inflating a gzip body chunk by chunk while
+		it arrives. With stream=True the body is left unread.
+		'''
+		resp = self.__send_request(req)
+		if stream:
+			return resp, None
+		if resp.info().get('Content-Encoding') != 'gzip':
+			return resp, resp.read()
+		return resp, _BodyStream(resp, True).read()
+
+
 	def __send_request(self, req):
 		"""Sends the request and returns the response, optionally ignoring ssl errors."""
 
@@ -164,6 +367,82 @@ class Connection(object):
 							   context = ssl._create_unverified_context() if self.__ignore_ssl_errors else None)
 
 
+def _make_request(rtype, uri, data, headers):
+	'''
+	urllib Request with the given method. Without it urllib sends GET, or POST if
+	there is data, whatever rtype is.
+	'''
+	req = urllib.request.Request(uri, data=data, headers=headers)
+	req.get_method = lambda: rtype
+	return req
+
+
+class _BodyStream(object):
+	'''
+	File-like body of a response. A gzip body is inflated chunk by chunk as it is read
+	from the socket, with zlib rather than gzip.GzipFile, which needs tell() on the
+	response and Python 2 responses have none. release, if given, is called once the
+	body has been read to the end (recording the latency of the request) or closed
+	before that (not recording it).
+	'''
+	def __init__(self, resp, gzipped, release=None):
+		self.__resp 	= resp
+		self.__release 	= release
+		self.__inflater = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+		self.__buf 		= b''
+		self.__eof 		= False
+
+
+	def read(self, n=-1):
+
+		if n is None or n < 0:
+			chunks = [self.__buf]
+			while not self.__eof:
+				chunks.append(self.__read_chunk())
+			self.__buf = b''
+			return b''.join(chunks)
+
+		chunks, size = [self.__buf], len(self.__buf)
+		while size < n and not self.__eof:
+			chunk = self.__read_chunk()
+			chunks.append(chunk)
+			size += len(chunk)
+		data = b''.join(chunks)
+		self.__buf = data[n:]
+		return data[:n]
+
+
+	def close(self):
+
+		self.__done(record=False)
+		self.__resp.close()
+
+
+	def __done(self, record):
+
+		release, self.__release = self.__release, None
+		if release is not None:
+			release(record)
+
+
+	def __read_chunk(self):
+
+		chunk = self.__resp.read(Connection.chunk_size)
+		if not chunk:
+			self.__eof = True
+			self.__done(record=True)
+			return self.__inflater.flush() if self.__inflater is not None else b''
+		return self.__inflater.decompress(chunk) if self.__inflater is not None else chunk
+
+
+class _Call(object):
+	'''A request in flight that other callers can wait for.'''
+	def __init__(self):
+		self.done 	= threading.Event()
+		self.result = None
+		self.error 	= None
+
+
 def print_resp(resp):
 	
 	for r in resp:
@@ -0,0 +1,152 @@
+from __future__ import division
+from builtins import object
+import emspy
+
+import os, re, sqlite3, threading, time, zlib
+from email.utils import parsedate_tz, mktime_tz
+
+
+# Metadata endpoints that rarely change. The cache is used for these by default.
+default_uri_keys = [
+	('ems_sys', 'list'),
+	('fleet', 'list'),
+	('aircraft', 'list'),
+	('airport', 'list'),
+	('flt_phase', 'list'),
+	('database', 'group'),
+	('database', 'field_group'),
+	('analytic', 'search')
+]
+
+
+class HttpCache(object):
+	'''
+	On-disk cache of GET responses for a Connection. Bodies are stored zlib-compressed in
+	a SQLite file together with their ETag / Last-Modified validators and the expiry
+	given by Cache-Control. Fresh entries are served without a request; stale ones are
+	revalidated with a conditional GET, so an unchanged resource costs a 304 and no
+	body. The least recently used entries are evicted beyond max_bytes.
+	'''
+
+	def __init__(self, cache_file=None, max_bytes=200 * 2**20, uri_keys=None):
+
+		if cache_file is None:
+			cache_file = os.path.join(emspy.__path__[0], "data", "httpCache.db")
+		self.cache_file = os.path.abspath(cache_file)
+		self.max_bytes 	= max_bytes
+		self.uri_keys 	= set(tuple(k) for k in (uri_keys if uri_keys is not None else default_uri_keys))
+		self.__lock 	= threading.Lock()
+		self.__conn 	= sqlite3.connect(self.cache_file, check_same_thread=False)
+		self.__conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+			key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, expires REAL,
+			last_access REAL, size INTEGER, body BLOB)""")
+		self.__conn.commit()
+
+
+	def covers(self, uri_keys):
+		'''Whether responses of the given common.uris keys are cached.'''
+		return (uri_keys is not None) and (tuple(uri_keys) in self.uri_keys)
+
+
+	def get(self, key):
+		'''
+		Returns the cached entry of a key as a dict with etag, last_modified, expires and
+		the decompressed body, or None.
+		'''
+		with self.__lock:
+			row = self.__conn.execute(
+				"SELECT etag, last_modified, expires, body FROM responses WHERE key = ?", (key,)).fetchone()
+			if row is None:
+				return None
+			self.__conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+			self.__conn.commit()
+		return {'etag': row[0], 'last_modified': row[1], 'expires': row[2],
+				'body': zlib.decompress(bytes(row[3]))}
+
+
+	def is_fresh(self, entry):
+
+		return (entry['expires'] is not None) and (entry['expires'] > time.time())
+
+
+	def validators(self, entry):
+		'''Conditional request headers for revalidating an entry.'''
+		h = dict()
+		if entry['etag'] is not None:
+			h['If-None-Match'] = entry['etag']
+		if entry['last_modified'] is not None:
+			h['If-Modified-Since'] = entry['last_modified']
+		return h
+
+
+	def put(self, key, headers, body):
+		'''
+		Stores a 200 response body, unless Cache-Control forbids it or the response has
+		neither validators nor a lifetime.
+		'''
+		expires, store = _expiry(headers)
+		etag, modified = headers.get('ETag'), headers.get('Last-Modified')
+		if not store or (etag is None and modified is None and expires is None):
+			return
+		data = zlib.compress(body)
+		with self.__lock:
+			self.__conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+								(key, etag, modified, expires, time.time(), len(data), sqlite3.Binary(data)))
+			self.__evict()
+			self.__conn.commit()
+
+
+	def refresh(self, key, headers):
+		'''Updates the expiry of an entry after a 304 Not Modified.'''
+		expires, store = _expiry(headers)
+		with self.__lock:
+			self.__conn.execute("UPDATE responses SET expires = ?, last_access = ? WHERE key = ?",
+								(expires, time.time(), key))
+			self.__conn.commit()
+
+
+	def clear(self):
+
+		with self.__lock:
+			self.__conn.execute("DELETE FROM responses")
+			self.__conn.commit()
+
+
+	def close(self):
+
+		self.__conn.close()
+
+
+	def __evict(self):
+
+		total = self.__conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+		if total <= self.max_bytes:
+			return
+		rows = self.__conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+		drop = []
+		for key, size in rows:
+			if total <= self.max_bytes:
+				break
+			drop.append((key,))
+			total -= size
+		self.__conn.executemany("DELETE FROM responses WHERE key = ?", drop)
+
+
+def _expiry(headers):
+	'''
+	Reads Cache-Control (and Expires) of a response. Returns the expiry time, or None
+	when the response has to be revalidated, and whether it may be stored at all.
+	'''
+	cc = (headers.get('Cache-Control') or '').lower()
+	if 'no-store' in cc:
+		return None, False
+	if 'no-cache' in cc:
+		return None, True
+	m = re.search(r'max-age=(\d+)', cc)
+	if m is not None:
+		return time.time() + int(m.group(1)), True
+	exp = headers.get('Expires')
+	date = parsedate_tz(exp) if exp else None
+	if date is not None:
+		return mktime_tz(date), True
+	return None, True
@@ -1,3 +1,4 @@
+from emspy.query.registry import AssetRegistry, shared_assets
 from emspy.query.ems import EMS
 from emspy.query.fleet import Fleet
 from emspy.query.aircraft import Aircraft
@@ -7,6 +8,9 @@ from emspy.query.localdata import LocalData
 from emspy.query.flight import Flight
 from emspy.query.analytic import Analytic
 from emspy.query.fltquery import FltQuery
+from emspy.query.asyncquery import AsyncQuery, AsyncQueryPool
 from emspy.query.tsquery import TSeriesQuery
 
-
+import sys
+if sys.version_info >= (3, 5):
+	from emspy.query.aioquery import AsyncFltQuery, AsyncTSeriesQuery
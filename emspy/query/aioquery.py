@@ -0,0 +1,182 @@
+from __future__ import print_function
+import asyncio
+import time
+from collections import deque
+import pandas as pd
+
+from emspy.aioconnection import AsyncConnection
+from .fltquery import FltQuery
+from .paging import PageSchedule
+from .tsquery import TSeriesQuery
+
+'''
+Asyncio counterparts of the flight and time-series queries. They build their queries
+with the same code as FltQuery and TSeriesQuery, and send them through an
+AsyncConnection so that many queries can run concurrently on one event loop.
+'''
+
+
+class _AsyncQuery(object):
+	'''
+	AsyncConnection of an asyncio query. Without a shared aconn, the query makes its own,
+	whose thread pool close shuts down; "async with" closes it on the way out:
+
+	>> async with AsyncFltQuery(c, "ems9") as q:
+	>>     df = await q.run()
+	'''
+
+	def _init_aconn(self, conn, aconn, max_concurrency):
+
+		# A shared AsyncConnection is left to its owner to close
+		self.__own_aconn = aconn is None
+		self._aconn = aconn if aconn is not None else AsyncConnection(conn, max_concurrency)
+
+
+	def close(self):
+
+		if self.__own_aconn:
+			self._aconn.close()
+
+
+	async def __aenter__(self):
+
+		return self
+
+
+	async def __aexit__(self, exc_type, exc_value, traceback):
+
+		self.close()
+		return False
+
+
+class AsyncFltQuery(_AsyncQuery, FltQuery):
+	'''
+	FltQuery whose run, simple_run and async_run are coroutines. Database and field
+	tree setup, select, filter etc. are the same as FltQuery. Pass a shared
+	AsyncConnection as aconn to put a single concurrency limit on many queries.
+	'''
+
+	def __init__(self, conn, ems_name, data_file = None, aconn = None, max_concurrency = 16):
+
+		FltQuery.__init__(self, conn, ems_name, data_file)
+		self._init_aconn(conn, aconn, max_concurrency)
+
+
+	async def simple_run(self, output = "dataframe"):
+
+		resp_h, raw = await self._aconn.request(raw = True, **self._query_request('simple'))
+		content = await self._aconn.run(self._decode, raw)
+		self._warn_truncated(content)
+
+		if output == "raw":
+			return content
+		elif output == "dataframe":
+			return await self._aconn.run(self._page_to_dataframe, content)
+		else:
+			raise ValueError("Requested an unknown output type.")
+
+
+	async def async_run(self, n_row = 25000, prefetch = 2, n_proc = None, max_retries = 3):
+		'''
+		Coroutine of FltQuery.async_run, with the same page schedule, retries and
+		re-opening of expired queries, and n_proc conversion. Checkpoints are not
+		supported.
+		'''
+		query = await self._aconn.call(self.open_async)
+		schedule = PageSchedule(n_row)
+		read, to_dataframe, converter = self._page_reader(query, n_proc, max_retries)
+		if converter is not None:
+			prefetch = max(prefetch, n_proc)
+
+		# Pages are fetched ahead of the one being converted, as in FltQuery.async_run
+		def fetch():
+			start, end = schedule.next_page()
+			return start, end, asyncio.ensure_future(self._aconn.call(read, start, end))
+		pages = deque(fetch() for i in range(prefetch))
+
+		dfs = []
+		try:
+			while True:
+				pages.append(fetch())
+				start, end, page = pages.popleft()
+				res, seconds = await page
+				dff = await self._aconn.run(to_dataframe, res)
+				dfs.append(dff)
+				if schedule.page_done(start, end, dff.shape[0], seconds, dff.memory_usage(index = False).sum()):
+					break
+		except Exception as e:
+			print("Something's wrong (%s). Returning what has been sent so far." % e)
+		finally:
+			for start, end, f in pages:
+				f.cancel()
+			if converter is not None:
+				converter.shutdown(wait = False)
+			# Always free the query on the server
+			await self._aconn.call(query.close)
+
+		if len(dfs) == 0:
+			return None
+		return pd.concat(dfs, ignore_index = True) if len(dfs) > 1 else dfs[0]
+
+
+	async def run(self, n_row = 25000, prefetch = 2, n_proc = None, plan = "auto"):
+		'''
+		Coroutine of FltQuery.run, with the same planner and plan_log entries.
+		'''
+		path, entry = await self._aconn.call(self._start_run, plan)
+		t1 = time.time()
+		df = None
+		if path == "simple":
+			df = await self.simple_run(output = "dataframe")
+			path = self._after_simple(plan, df, entry, t1)
+		if path == "async":
+			df = await self.async_run(n_row = n_row, prefetch = prefetch, n_proc = n_proc)
+		self._end_run(entry, path, df, t1)
+		return df
+
+
+class AsyncTSeriesQuery(_AsyncQuery, TSeriesQuery):
+	'''
+	TSeriesQuery whose run and multi_run are coroutines. multi_run sends the queries of
+	all flights (and all windows of each flight) concurrently, up to the concurrency
+	limit of the AsyncConnection.
+	'''
+
+	def __init__(self, conn, ems_name, data_file = None, aconn = None, max_concurrency = 16):
+
+		TSeriesQuery.__init__(self, conn, ems_name, data_file)
+		self._init_aconn(conn, aconn, max_concurrency)
+
+
+	async def __fetch(self, flight, qs):
+
+		resp_h, content = await self._aconn.request(**self._ts_request(flight, qs))
+		return self._ts_dataframe(flight, content)
+
+
+	async def __run(self, flight, start, end, timestep, timepoint, window):
+
+		qs = self._timeframe(start, end, timestep, timepoint)
+		if window is None:
+			return await self.__fetch(flight, qs)
+		querysets = self._split_windows(qs, window)
+		dfs = await asyncio.gather(*[self.__fetch(flight, q) for q in querysets])
+		return self._stitch(qs, list(dfs))
+
+
+	async def run(self, flight, start = None, end = None, timestep = None, timepoint = None, window = None):
+
+		df = await self.__run(flight, start, end, timestep, timepoint, window)
+		return self._apply_derived([df])[0]
+
+
+	async def multi_run(self, flight, start = None, end = None, timestep = None, timepoint = None, window = None):
+
+		# Looking up the flight data sends blocking requests; keep them off the event loop
+		FR, flt_data, start, end, timestep = await self._aconn.run(
+			self._multi_args, flight, start, end, timestep, timepoint)
+
+		dfs = await asyncio.gather(*[self.__run(fr, start[i], end[i], timestep[i], None, window)
+									 for i, fr in enumerate(FR)])
+		dfs = self._apply_derived(list(dfs))
+		return [{'flt_data': d, 'ts_data': df} for d, df in zip(flt_data, dfs)]
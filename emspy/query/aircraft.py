@@ -9,12 +9,12 @@ class Aircraft(Asset):
 
 		Asset.__init__(self, conn, "Aircraft")
 		self._ems_id = ems_id
-		self.update_list()
+		self.update_list(refresh=False)
 
 
-	def update_list(self):
+	def update_list(self, refresh=True):
 
-		Asset.update_list(self, uri_keys=('aircraft','list'), uri_args=self._ems_id)
+		Asset.update_list(self, uri_keys=('aircraft','list'), uri_args=self._ems_id, refresh=refresh)
 		self._rename_datacol('description', 'name')
 
 
@@ -32,8 +32,19 @@ class Aircraft(Asset):
 
 	def search_by_fleetid(self, fleetid):
 		
-		a   = self.list_all()
-		idx = [row.id for row in a.itertuples() if fleetid in row.fleetIds]
-		return a[a['id'].isin(idx)]
+		return self.list_all().iloc[self._fleet_index().get(fleetid, [])]
+
+
+	def _fleet_index(self):
+		'''
+		Inverted index of fleet id -> row positions of the aircraft in the fleet.
+		'''
+		if 'fleets' not in self._indexes:
+			idx = dict()
+			for pos, fids in enumerate(self.list_all()['fleetIds'].values):
+				for f in fids:
+					idx.setdefault(f, []).append(pos)
+			self._indexes['fleets'] = idx
+		return self._indexes['fleets']
 
 
@@ -1,6 +1,15 @@
 from __future__ import absolute_import
+from __future__ import division
+from builtins import object
 from .asset import Asset
 
+import numpy as np
+
+try:
+	from scipy.spatial import cKDTree
+except ImportError:
+	cKDTree = None
+
 
 class Airport(Asset):
 	'''Manages airport info'''
@@ -11,17 +20,22 @@ class Airport(Asset):
 		'city': 'city',
 		'name': 'name'
 	}
+	_earth_radius = {
+		'nm': 3440.065,
+		'km': 6371.0088,
+		'mi': 3958.761
+	}
 
 	def __init__(self, conn, ems_id):
 
 		Asset.__init__(self, conn, "Airport")
 		self._ems_id = ems_id
-		self.update_list()
+		self.update_list(refresh=False)
 
 
-	def update_list(self):
+	def update_list(self, refresh=True):
 
-		Asset.update_list(self, uri_keys=('airport','list'), uri_args=self._ems_id, colsort=False)
+		Asset.update_list(self, uri_keys=('airport','list'), uri_args=self._ems_id, colsort=False, refresh=refresh)
 
 
 	def get_id(self, name = None, code='default'):
@@ -33,4 +47,129 @@ class Airport(Asset):
 	def get_name(self, id_val = None, code='default'):
 
 		a = self.search('id', id_val, searchtype="match")[Airport._col_tr[code]].tolist()
-		return a if len(a) > 1 else a[0]
\ No newline at end of file
+		return a if len(a) > 1 else a[0]
+
+
+	def get_ids(self, names, code='default'):
+		'''Bulk version of get_id with exact, case-insensitive code or name matching.'''
+		return self.lookup(Airport._col_tr[code], names, 'id', case=False)
+
+
+	def get_names(self, ids, code='default'):
+		'''Bulk version of get_name.'''
+		return self.lookup('id', ids, Airport._col_tr[code])
+
+
+	def nearest(self, lat, lon, unit='nm'):
+		'''
+		Finds the nearest airport of each of the given points by great-circle distance.
+
+		Input
+		-----
+		lat, lon: list-like latitudes and longitudes in degrees
+		unit    : distance unit, one of "nm" (default), "km" and "mi"
+
+		Output
+		------
+		Tuple of numpy arrays: airport ids and distances, one per point. Points with a
+		missing (NaN) or infinite coordinate get a NaN id and distance; the ids are then
+		floats, as in pandas.
+		'''
+		idx = self._spatial_index()
+		xyz = _to_xyz(lat, lon)
+		ok  = np.isfinite(xyz).all(axis=1)
+		ids = self.list_all()['id'].values
+		if ok.all():
+			pos, ang = idx.nearest(xyz)
+			return ids[idx.rows[pos]], ang * Airport._earth_radius[unit]
+
+		out_ids  = np.full(len(xyz), np.nan)
+		out_dist = np.full(len(xyz), np.nan)
+		if ok.any():
+			pos, ang = idx.nearest(xyz[ok])
+			out_ids[ok]  = ids[idx.rows[pos]]
+			out_dist[ok] = ang * Airport._earth_radius[unit]
+		return out_ids, out_dist
+
+
+	def within(self, lat, lon, radius, unit='nm'):
+		'''
+		Returns the airports within a great-circle radius of a point, nearest first, with
+		their distances in a "distance" column.
+		'''
+		idx = self._spatial_index()
+		p = _to_xyz(lat, lon)[0]
+		if not np.isfinite(p).all():
+			a = self.list_all().iloc[[]].copy()
+			a['distance'] = np.array([], dtype=float)
+			return a
+		pos, ang = idx.within(p, radius / Airport._earth_radius[unit])
+		order = np.argsort(ang, kind='mergesort')
+		a = self.list_all().iloc[idx.rows[pos[order]]].copy()
+		a['distance'] = ang[order] * Airport._earth_radius[unit]
+		return a
+
+
+	def _spatial_index(self):
+		'''
+		Spatial index over the airport coordinates, skipping airports without them. It
+		lives in the asset index cache, so a reloaded airport list gets a new one.
+		'''
+		if 'spatial' not in self._indexes:
+			a = self.list_all()
+			lat = a['latitude'].values.astype(float)
+			lon = a['longitude'].values.astype(float)
+			rows = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+			self._indexes['spatial'] = _SphereIndex(_to_xyz(lat[rows], lon[rows]), rows)
+		return self._indexes['spatial']
+
+
+class _SphereIndex(object):
+	'''
+	Nearest-neighbor index of points on the unit sphere, stored as 3D unit vectors. The
+	chord distance between unit vectors grows with the great-circle angle, so Euclidean
+	nearest neighbors are great-circle nearest neighbors. Uses a k-d tree when scipy is
+	available, and blockwise dot products in numpy otherwise.
+	'''
+	_block = 2 ** 22
+
+	def __init__(self, xyz, rows):
+
+		self.xyz  = xyz
+		self.rows = rows
+		self.tree = cKDTree(xyz) if cKDTree is not None else None
+
+
+	def nearest(self, q):
+
+		if self.tree is not None:
+			chord, pos = self.tree.query(q)
+			return pos, 2 * np.arcsin(np.minimum(chord / 2, 1.0))
+
+		n   = max(1, self._block // max(1, len(self.xyz)))
+		pos = np.empty(len(q), dtype=int)
+		cos = np.empty(len(q))
+		for i in range(0, len(q), n):
+			d = q[i:i+n].dot(self.xyz.T)
+			pos[i:i+n] = d.argmax(axis=1)
+			cos[i:i+n] = d[np.arange(len(d)), pos[i:i+n]]
+		return pos, np.arccos(np.clip(cos, -1.0, 1.0))
+
+
+	def within(self, p, angle):
+
+		if self.tree is not None:
+			pos = np.array(self.tree.query_ball_point(p, 2 * np.sin(min(angle, np.pi) / 2)), dtype=int)
+		else:
+			pos = np.flatnonzero(self.xyz.dot(p) >= np.cos(min(angle, np.pi)))
+		ang = np.arccos(np.clip(self.xyz[pos].dot(p), -1.0, 1.0))
+		return pos, ang
+
+
+def _to_xyz(lat, lon):
+
+	lat = np.radians(np.atleast_1d(np.asarray(lat, dtype=float)))
+	lon = np.radians(np.atleast_1d(np.asarray(lon, dtype=float)))
+	# An infinite coordinate gives NaN, like a missing one
+	with np.errstate(invalid='ignore'):
+		return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
@@ -1,9 +1,10 @@
 from __future__ import print_function
-from builtins import range
 from builtins import object
 import pandas as pd
 import numpy as np
 import os, sys, re
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 import emspy
 from emspy.query import LocalData
 
@@ -25,6 +26,7 @@ class Analytic(object):
 				self._metadata = LocalData(file_name)
 
 		self._param_table = self._metadata.get_data("params", "ems_id = %d" % self._ems_id)
+		self._build_index()
 
 	
 	def _save_paramtable(self):
@@ -33,51 +35,201 @@ class Analytic(object):
 			self._metadata.append_data("params", self._param_table)
 
 
+	def _build_index(self):
+		'''
+		Builds the in-memory param catalog from the param table. Params are kept in
+		records with a lookup by analytic id. The search index is built on the first
+		search: the lowercase names sorted once by their length, joined into a single
+		string so that a substring search is one scan in C and hits the shortest name
+		first.
+		'''
+		self.__records  = self._param_table.to_dict('records')
+		self.__by_id    = dict((r['id'], i) for i, r in enumerate(self.__records))
+		self.__names    = [r['name'].lower() for r in self.__records]
+		self.__searched = dict()
+		self.__text     = None
+
+
+	def __search_index(self):
+
+		if self.__text is None:
+			names = np.array(self.__names, dtype = str)
+			lens  = np.char.str_len(names)
+			order = np.lexsort((names, lens))
+			self.__order  = order.tolist()
+			self.__text   = "\n".join(names[order].tolist())
+			# Offset of each name in the joined text
+			self.__starts = (np.cumsum(lens[order] + 1) - (lens[order] + 1)).tolist()
+		return self.__text, self.__order, self.__starts
+
+
+	def __find(self, kw):
+		'''Record indexes of the names containing kw, ordered by name length.'''
+		if "\n" in kw:
+			return []
+		text, order, starts = self.__search_index()
+		if len(starts) == 0:
+			return []
+		hits = []
+		j = text.find(kw)
+		while j >= 0:
+			k = bisect_right(starts, j) - 1
+			hits.append(order[k])
+			# Go on from the next name, so that a name is hit only once
+			if k + 1 >= len(starts):
+				break
+			j = text.find(kw, starts[k + 1])
+		return hits
+
+
+	def add_params(self, params):
+		'''
+		Adds params to the param table, skipping the ones that are already there. Only
+		the new params are appended to the local data file.
+
+		Input
+		-----
+		params: list of param dicts or Pandas DataFrame, as returned by search_param
+
+		Output
+		------
+		Number of params that were added
+		'''
+		if isinstance(params, pd.DataFrame):
+			params = params.to_dict('records')
+
+		new = []
+		for p in params:
+			if p['id'] in self.__by_id:
+				continue
+			p = dict(p, ems_id = self._ems_id)
+			self.__by_id[p['id']] = len(self.__records)
+			self.__records.append(p)
+			self.__names.append(p['name'].lower())
+			new.append(p)
+
+		if len(new) > 0:
+			new_df = pd.DataFrame(new).reindex(columns = LocalData.table_info['params'])
+			self._param_table = pd.concat([self._param_table, new_df], ignore_index = True)
+			self._metadata.append_data("params", new_df)
+			self.__searched = dict()
+			self.__text     = None
+		return len(new)
+
+
+	def get_param_by_id(self, analytic_id):
+		'''
+		Returns the param with the given analytic id from the param table, or None if
+		it is not there.
+		'''
+		i = self.__by_id.get(analytic_id)
+		return None if i is None else dict(self.__records[i])
+
+
 	def search_param(self, keyword, in_df = False):
 		print('Searching for params with keyword "%s" from EMS ...' % keyword, end=' ')
-		# EMS API Call
-		resp_h, content = self._conn.request( uri_keys=('analytic', 'search'),
-											  uri_args=self._ems_id,
-											  body={'text': keyword})
-		if len(content) == 0:
+		res = self.__search(keyword)
+		if len(res) == 0:
 			sys.exit("No parameter found with search keyword %s." % keyword)
-		elif len(content) == 1:
-			res = content
-		else:
-			word_len     = [len(x['name']) for x in content]
-			idx          = np.argsort(word_len).tolist()
-			res          = [content[i] for i in idx]
 		print("done.")
 
-		for i in range(len(res)):
-			res[i]['ems_id'] = self._ems_id
-
 		if in_df:
 			return pd.DataFrame(res)
 		
 		return res
+
+
+	def search_params(self, keywords, n_workers = 8):
+		'''
+		Searches for params of many keywords from EMS at once. Duplicate keywords are
+		searched only once, the searches are sent concurrently, and all new params are
+		added to the param table with a single write.
+
+		Input
+		-----
+		keywords : list of param keywords
+		n_workers: max number of concurrent search calls. Default is 8.
+
+		Output
+		------
+		Dict of keyword -> list of found params, ordered by name length
+		'''
+		uniq = list(dict.fromkeys(keywords))
+		if len(uniq) == 0:
+			return dict()
+
+		print('Searching for params with %d keywords from EMS ...' % len(uniq), end=' ')
+		with ThreadPoolExecutor(max_workers = min(n_workers, len(uniq))) as ex:
+			res = dict(zip(uniq, ex.map(self.__search, uniq)))
+		print("done.")
+
+		not_found = [kw for kw in uniq if len(res[kw]) == 0]
+		if len(not_found) > 0:
+			sys.exit("No parameter found with search keywords %s." % not_found)
+
+		self.add_params([p for kw in uniq for p in res[kw]])
+		return res
+
+
+	def __search(self, keyword):
+
+		# EMS API Call
+		resp_h, content = self._conn.request( uri_keys=('analytic', 'search'),
+											  uri_args=self._ems_id,
+											  body={'text': keyword})
+		idx = np.argsort([len(x['name']) for x in content], kind = 'mergesort').tolist()
+		return [dict(content[i], ems_id = self._ems_id) for i in idx]
+
+
+	def build_catalog(self, n_workers = 8):
+		'''
+		Crawls the whole analytic group tree of the EMS system and adds every analytic
+		to the param table, so that later param lookups need no API calls. The groups
+		of each tree level are requested concurrently.
+
+		Output
+		------
+		Number of params that were newly added
+		'''
+		def fetch(group_id):
+			body = None if group_id is None else {'groupId': group_id}
+			resp_h, content = self._conn.request( uri_keys=('analytic', 'group'),
+												  uri_args=self._ems_id,
+												  body=body)
+			return content
+
+		print('Building the analytic catalog from EMS ...')
+		params = []
+		level  = [None]
+		with ThreadPoolExecutor(max_workers = n_workers) as ex:
+			while len(level) > 0:
+				groups = list(ex.map(fetch, level))
+				for g in groups:
+					params += g.get('analytics', [])
+				level = [x['id'] for g in groups for x in g.get('groups', [])]
+				print("-- Found %d params so far" % len(params))
+
+		n = self.add_params(params)
+		print("Done. Added %d new params." % n)
+		return n
 		
 
 	def get_param(self, keyword, unique = True):
-		# if the param table is empty, just return an empty param dict.
-		if self._param_table.empty:
-			return dict(ems_id="", id="", name="", description="", units="")
-		# If the param table is not empty, do search by keyword
-		bool_idx = self._param_table['name'].str.contains(keyword, case = False, regex=False)
-		df = self._param_table[bool_idx]
+		'''
+		Case-insensitive substring search of the param table. Returns the param with
+		the shortest name, or all matching params ordered by name length when
+		unique = False. An empty param dict is returned if there is no match.
+		'''
+		kw = keyword.lower()
+		if kw not in self.__searched:
+			self.__searched[kw] = self.__find(kw)
+		hits = self.__searched[kw]
+
 		# If the search result is empty, return empty param dict
-		if df.empty:
+		if len(hits) == 0:
 			return dict(ems_id="", id="", name="", description="", units="")
-		# If not empty, return the one with shortest name
-		if df.shape[0] > 1:
-			idx = df['name'].map(lambda x: len(x)).sort_values().index
-			df  = df.loc[idx, :]
 		# When unique = True
 		if unique:
-			return df.iloc[0,:].to_dict()
-        # When unique = False
-		return df.to_dict('records')
-
-
-
-
+			return dict(self.__records[hits[0]])
+		# When unique = False
+		return [dict(self.__records[i]) for i in hits]
@@ -1,5 +1,6 @@
 from builtins import object
 import pandas as pd
+from .registry import shared_assets
 
 
 class Asset(object):
@@ -13,15 +14,20 @@ class Asset(object):
 		self._conn = conn
 		self._asset_type = asset_type
 		self._assets = None
+		self._indexes = dict()
 
 
-	def update_list(self, uri_keys=None, uri_args=None, body=None, colsort=True):
-
-		resp_h, dict_data = self._conn.request(uri_keys=uri_keys, uri_args=uri_args, body=body)
+	def update_list(self, uri_keys=None, uri_args=None, body=None, colsort=True, refresh=True):
+		'''
+		Loads the asset list through the process-wide asset registry. With refresh=False
+		a list already loaded for the connection is reused without an API call.
+		'''
+		dict_data = shared_assets.get(self._conn, uri_keys, uri_args, body, refresh=refresh)
 		a = pd.DataFrame.from_dict(dict_data)
 		if colsort:
 			a = a[sorted(a.columns, key=len)]
 		self._assets = a
+		self._indexes = dict()
 
 
 	def list_all(self):
@@ -42,7 +48,63 @@ class Asset(object):
 			if searchtype=="match":
 				return a[a[col].str.match(val, case=False)]
 		
-		return a[a[col]==val]
+		return a.iloc[self._index(col).get(val, [])]
+
+
+	def _index(self, col, case=True):
+		'''
+		Exact-match hash index of a column, mapping each value (lowercased if case=False)
+		to its row positions. Built on first use and kept until the list is updated.
+		'''
+		key = ('rows', col, case)
+		if key not in self._indexes:
+			vals = self._assets[col]
+			if not case:
+				vals = vals.str.lower()
+			idx = dict()
+			for pos, v in enumerate(vals.values):
+				idx.setdefault(v, []).append(pos)
+			self._indexes[key] = idx
+		return self._indexes[key]
+
+
+	def lookup(self, col, vals, target, case=True):
+		'''
+		Vectorized exact-match lookup. Maps an array of values of column col to the
+		values of column target, as a hash join over the asset list. Values without a
+		match give NaN. If a value matches several assets the first one is used.
+
+		Input
+		-----
+		col   : column to match vals against
+		vals  : list-like of values
+		target: column whose values are returned
+		case  : case-sensitive match of strings. Default is True.
+
+		Output
+		------
+		numpy array with one value per input value
+		'''
+		key = ('map', col, target, case)
+		if key not in self._indexes:
+			a    = self._assets
+			keys = a[col] if case else a[col].str.lower()
+			m    = pd.Series(a[target].values, index=keys.values)
+			self._indexes[key] = m[~m.index.duplicated()]
+		vals = pd.Series(vals)
+		if not case:
+			vals = vals.str.lower()
+		return self._indexes[key].reindex(vals.values).values
+
+
+	def get_ids(self, names):
+		'''Bulk version of get_id with exact, case-insensitive name matching.'''
+		return self.lookup('name', names, 'id', case=False)
+
+
+	def get_names(self, ids):
+		'''Bulk version of get_name.'''
+		return self.lookup('id', ids, 'name')
 
 
 	def get_id(self, name = None, keyword = None):
@@ -58,6 +120,7 @@ class Asset(object):
 	def _rename_datacol(self, old, new):
 
 		self._assets = self._assets.rename(columns = {old:new})
+		self._indexes = dict()
 
 
 	def data_colnames(self):
@@ -0,0 +1,130 @@
+from __future__ import print_function
+from __future__ import absolute_import
+from builtins import object
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Lifecycle of server-side async queries. An open async query holds resources on the
+EMS server until it is closed or expires, so FltQuery opens them through AsyncQuery,
+which closes them when done, and AsyncQueryPool caps how many are open at a time.
+'''
+
+
+class AsyncQuery(object):
+	'''
+	An async query open on the server, used as a context manager that closes it on the
+	way out, whether the block finished or raised:
+
+	>> with query.open_async() as aq:
+	>>     print(aq.id, aq.header)
+
+	It is opened with open_func unless an id and header are given. When the server has
+	expired it, reopen gets a new one; concurrent readers that saw the same stale id
+	re-open it only once. Set keep_open to leave it open on the way out, e.g. to resume
+	reading it later.
+	'''
+	def __init__(self, open_func, close_func, query_id = None, header = None):
+
+		self.__open 	= open_func
+		self.__close 	= close_func
+		self.__lock 	= threading.Lock()
+		if query_id is None:
+			query_id, header = open_func()
+		self.id 		= query_id
+		self.header 	= header
+		self.keep_open 	= False
+		self.closed 	= False
+
+
+	def reopen(self, stale_id):
+
+		with self.__lock:
+			if self.closed:
+				# e.g. a page read ahead past the end, still running after the close
+				raise ValueError("The async query %s is closed." % self.id)
+			if self.id != stale_id:
+				return
+			query_id, header = self.__open()
+			if [h['name'] for h in header] != [h['name'] for h in self.header]:
+				raise ValueError("The re-opened async query returned different columns.")
+			self.id = query_id
+
+
+	def close(self):
+		'''
+		Closes the query on the server. A failure to close is reported but not raised,
+		since the server expires the query anyway.
+		'''
+		with self.__lock:
+			if self.closed:
+				return
+			self.closed = True
+			try:
+				self.__close(self.id)
+			except Exception as e:
+				print("Closing the async query %s failed: %s" % (self.id, e))
+
+
+	def __enter__(self):
+
+		return self
+
+
+	def __exit__(self, exc_type, exc_value, traceback):
+
+		if not self.keep_open:
+			self.close()
+		return False
+
+
+class AsyncQueryPool(object):
+	'''
+	Runs the async queries of many FltQuery objects concurrently with at most max_open
+	of them open on the server at a time. Each running query still pipelines its own
+	page reads; the Connection's scheduler keeps the total request rate in check.
+
+	>> with AsyncQueryPool(max_open = 4) as pool:
+	>>     dfs = pool.run([q1, q2, q3, q4, q5, q6])
+	'''
+	def __init__(self, max_open = 4):
+
+		self.max_open 	= max_open
+		self.__executor = ThreadPoolExecutor(max_workers = max_open)
+
+
+	def submit(self, query, **kwargs):
+		'''
+		Schedules query.async_run(**kwargs). Returns a concurrent.futures.Future of the
+		DataFrame.
+		'''
+		return self.__executor.submit(query.async_run, **kwargs)
+
+
+	def submit_export(self, query, path, **kwargs):
+		'''Schedules query.export(path, **kwargs). Returns a Future of the file list.'''
+		return self.__executor.submit(query.export, path, **kwargs)
+
+
+	def run(self, queries, **kwargs):
+		'''
+		Runs the async queries of all the given FltQuery objects and returns their
+		DataFrames in the same order.
+		'''
+		return [f.result() for f in [self.submit(q, **kwargs) for q in queries]]
+
+
+	def shutdown(self, wait = True):
+
+		self.__executor.shutdown(wait = wait)
+
+
+	def __enter__(self):
+
+		return self
+
+
+	def __exit__(self, exc_type, exc_value, traceback):
+
+		self.shutdown()
+		return False
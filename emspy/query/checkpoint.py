@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+import glob, hashlib, json, os
+import pandas as pd
+
+'''
+On-disk checkpoints of async queries, so that a failed FltQuery.async_run can resume
+from the next page instead of starting over.
+'''
+
+
+class AsyncCheckpoint(object):
+	'''
+	Checkpoint of an async query in a directory. state.json keeps the query id, the
+	result header, the number of completed pages and rows, and a hash of the query;
+	each completed page is spilled to page-NNNNN.pkl. A resumed run reads on from the
+	row after the completed ones, whatever the page size. A checkpoint of a different
+	query in the directory is discarded.
+	'''
+	state_file = "state.json"
+
+	def __init__(self, path, key):
+
+		self.path 	= path
+		self.key 	= hashlib.sha1(json.dumps(key, sort_keys = True).encode('utf-8')).hexdigest()
+		self.state 	= None
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+		fname = os.path.join(path, AsyncCheckpoint.state_file)
+		if os.path.exists(fname):
+			with open(fname) as f:
+				state = json.load(f)
+			if state.get('key') == self.key:
+				self.state = state
+			else:
+				print("The checkpoint in '%s' is of another query. Starting over." % path)
+				self.clear()
+
+
+	def resumable(self):
+
+		return self.state is not None
+
+
+	def start(self, query_id, header):
+
+		self.clear()
+		self.state = {'key': self.key, 'query_id': query_id, 'header': header, 'pages': 0, 'rows': 0}
+		self.__save()
+
+
+	def add_page(self, df, query_id):
+		'''Spills a completed page and records it. The page goes to disk first.'''
+		df.to_pickle(self.__page_file(self.state['pages']))
+		self.state['pages'] += 1
+		self.state['rows'] 	+= df.shape[0]
+		self.state['query_id'] = query_id
+		self.__save()
+
+
+	def load_pages(self):
+
+		return [pd.read_pickle(self.__page_file(i)) for i in range(self.state['pages'])]
+
+
+	def clear(self):
+
+		for f in glob.glob(os.path.join(self.path, "page-*.pkl")) + [os.path.join(self.path, AsyncCheckpoint.state_file)]:
+			if os.path.exists(f):
+				os.remove(f)
+		self.state = None
+
+
+	def __page_file(self, i):
+
+		return os.path.join(self.path, "page-%05d.pkl" % i)
+
+
+	def __save(self):
+
+		# Write and rename, so that a crash never leaves a half-written state
+		fname = os.path.join(self.path, AsyncCheckpoint.state_file)
+		with open(fname + ".tmp", 'w') as f:
+			json.dump(self.state, f)
+		_replace(fname + ".tmp", fname)
+
+
+def _replace(src, dst):
+
+	if hasattr(os, 'replace'):
+		os.replace(src, dst)
+	else:
+		if os.path.exists(dst):
+			os.remove(dst)
+		os.rename(src, dst)
@@ -0,0 +1,146 @@
+'''
+Derived time-series parameters. A derived parameter is a numpy expression over the
+selected analytics. The expression is compiled once and evaluated over the time series
+of a whole batch of flights at once, with the per-flight operations (rates, smoothing,
+shifts) done by group-aware vectorized functions.
+'''
+from __future__ import division
+from builtins import object
+import pandas as pd
+import numpy as np
+import ast
+
+
+class DerivedParam(object):
+
+    def __init__(self, name, expr, inputs):
+        '''
+        Input
+        -----
+        name  : column name of the derived parameter in the output data
+        expr  : expression string. It can use the variable names given in inputs, numpy
+                as "np", and the batch functions rate, smooth, shift and between.
+        inputs: dict of variable name -> column name of the input parameter
+        '''
+        self.name   = name
+        self.expr   = expr
+        self.inputs = dict(inputs)
+        self._code  = compile(expr, '<derived: %s>' % name, 'eval')
+
+        names   = set(n.id for n in ast.walk(ast.parse(expr, mode = 'eval')) if isinstance(n, ast.Name))
+        unknown = sorted(v for v in names if v not in self.inputs and v not in _namespace_names)
+        if len(unknown) > 0:
+            raise ValueError("Derived parameter '%s' uses undefined names %s." % (name, unknown))
+
+
+    def evaluate(self, batch):
+        '''
+        Evaluates the expression over a Batch. Returns a numpy array with one value per
+        row of the batch.
+        '''
+        env = batch.namespace()
+        for var, col in self.inputs.items():
+            env[var] = batch.column(col)
+        res = np.asarray(eval(self._code, {'__builtins__': {}}, env))
+        return np.broadcast_to(res, (batch.size,)).copy()
+
+
+class Batch(object):
+    '''
+    Time series of many flights stacked into one frame, with an integer group label per
+    row telling which flight the row belongs to.
+    '''
+
+    def __init__(self, dfs, time_col = "Time (sec)"):
+
+        self.lengths = np.array([len(df) for df in dfs], dtype = int)
+        self.size    = int(self.lengths.sum())
+        self.groups  = np.repeat(np.arange(len(dfs)), self.lengths)
+        self.frame   = pd.concat(dfs, ignore_index = True)
+        self.time    = self.column(time_col)
+        # True for the first row of each flight
+        self.starts  = np.ones(self.size, dtype = bool)
+        self.starts[1:] = self.groups[1:] != self.groups[:-1]
+
+
+    def column(self, col):
+        '''
+        Values of a column as a numpy array: boolean columns without missing values, e.g.
+        derived conditions, stay bool so that they combine with & and |; the rest are
+        cast to float.
+        '''
+        s = self.frame[col]
+        if (pd.api.types.is_bool_dtype(s.dtype) or pd.api.types.infer_dtype(s, skipna = False) == 'boolean') \
+                and not s.isna().any():
+            return s.to_numpy(dtype = bool)
+        return s.to_numpy(dtype = float)
+
+
+    def namespace(self):
+
+        return {
+            'np'     : np,
+            'abs'    : np.abs,
+            'min'    : np.minimum,
+            'max'    : np.maximum,
+            'rate'   : self.rate,
+            'smooth' : self.smooth,
+            'shift'  : self.shift,
+            'between': between
+        }
+
+
+    def rate(self, x):
+        '''Backward-difference time derivative per flight (units of x per second).'''
+        x   = np.asarray(x, dtype = float)
+        out = np.full(self.size, np.nan)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            out[1:] = np.diff(x) / np.diff(self.time)
+        out[self.starts] = np.nan
+        return out
+
+
+    def smooth(self, x, n):
+        '''Trailing moving average over n samples per flight.'''
+        s = pd.Series(np.asarray(x, dtype = float))
+        return s.groupby(self.groups).rolling(int(n), min_periods = 1).mean() \
+                .reset_index(level = 0, drop = True).sort_index().values
+
+
+    def shift(self, x, n = 1):
+        '''Shifts x by n samples within each flight.'''
+        return pd.Series(np.asarray(x, dtype = float)).groupby(self.groups).shift(int(n)).values
+
+
+    def split(self, values):
+        '''Splits a batch-length array back into per-flight arrays.'''
+        return np.split(np.asarray(values), np.cumsum(self.lengths)[:-1])
+
+
+def between(x, lo, hi):
+    '''Mask of lo <= x <= hi.'''
+    return (x >= lo) & (x <= hi)
+
+
+_namespace_names = ('np', 'abs', 'min', 'max', 'rate', 'smooth', 'shift', 'between')
+
+
+def apply_derived(dfs, derived, drop = (), time_col = "Time (sec)"):
+    '''
+    Adds the derived parameters as new columns of the given per-flight DataFrames, and
+    drops the columns listed in drop. All flights are evaluated in one batch.
+    '''
+    if len(dfs) == 0 or (len(derived) == 0 and len(drop) == 0):
+        return dfs
+
+    batch = Batch(dfs, time_col)
+    for d in derived:
+        vals = d.evaluate(batch)
+        # Later expressions can refer to earlier derived parameters by name
+        batch.frame[d.name] = vals
+        for df, v in zip(dfs, batch.split(vals)):
+            df[d.name] = v
+
+    for df in dfs:
+        df.drop(columns = [c for c in drop if c in df.columns], inplace = True)
+    return dfs
@@ -7,12 +7,12 @@ class EMS(Asset):
 
 	def __init__(self, conn):
 		Asset.__init__(self, conn, "EMS")
-		self.update_list()
+		self.update_list(refresh=False)
 
 
-	def update_list(self):
+	def update_list(self, refresh=True):
 
-		Asset.update_list(self, uri_keys=('ems_sys', 'list'))
+		Asset.update_list(self, uri_keys=('ems_sys', 'list'), refresh=refresh)
 
 
 
@@ -0,0 +1,68 @@
+'''
+Exceedance scanning over the time series of many flights. An exceedance is a run of
+samples of one flight where a condition holds, reported with its start, end, duration
+and the range of a measure over it. The runs are found from the edges of the condition
+mask of a derived.Batch, cut at the flight boundaries.
+'''
+from __future__ import division
+import pandas as pd
+import numpy as np
+
+
+def scan(batch, mask, min_duration = 0.0, measure = None, labels = None):
+    '''
+    Finds the intervals where mask is True in each flight of a Batch.
+
+    Input
+    -----
+    batch       : derived.Batch of the flights
+    mask        : boolean array with one value per row of the batch. NaN counts as False.
+    min_duration: minimum interval length in seconds. Shorter intervals are dropped.
+    measure     : optional column name. Its min/max within each interval are reported.
+    labels      : optional list of flight labels (e.g. Flight Records), one per flight
+
+    Output
+    ------
+    Pandas DataFrame with one row per exceedance interval
+    '''
+    m = np.asarray(mask)
+    if m.dtype != bool:
+        m = np.nan_to_num(m.astype(float)) != 0
+
+    # Runs start where the mask turns on or a flight begins with it on, and end where it
+    # turns off or the flight ends with it on.
+    ends_flt        = np.roll(batch.starts, -1)
+    ends_flt[-1:]   = True
+    prev_on         = np.concatenate(([False], m[:-1])) & ~batch.starts
+    next_on         = np.concatenate((m[1:], [False])) & ~ends_flt
+    i_start         = np.flatnonzero(m & ~prev_on)
+    i_end           = np.flatnonzero(m & ~next_on)
+
+    t        = batch.time
+    duration = t[i_end] - t[i_start]
+    keep     = duration >= min_duration
+    i_start, i_end, duration = i_start[keep], i_end[keep], duration[keep]
+
+    flt = batch.groups[i_start]
+    out = pd.DataFrame({
+        "Flight Record" : flt if labels is None else np.asarray(labels)[flt],
+        "start (sec)"   : t[i_start],
+        "end (sec)"     : t[i_end],
+        "duration (sec)": duration,
+        "samples"       : i_end - i_start + 1
+    }, columns = ["Flight Record", "start (sec)", "end (sec)", "duration (sec)", "samples"])
+
+    if measure is not None and len(i_start) > 0:
+        # reduceat over [start, end+1) slices. Runs never overlap so the slices are sorted.
+        x      = batch.column(measure)
+        bounds = np.column_stack((i_start, i_end + 1)).ravel()
+        pad    = bounds[-1] == len(x)
+        if pad:
+            x = np.append(x, np.nan)
+        out["max " + measure] = np.fmax.reduceat(x, bounds)[::2]
+        out["min " + measure] = np.fmin.reduceat(x, bounds)[::2]
+    elif measure is not None:
+        out["max " + measure] = []
+        out["min " + measure] = []
+
+    return out
@@ -0,0 +1,168 @@
+from __future__ import absolute_import
+import os
+import pandas as pd
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+
+'''
+Writers of flight query results to Parquet datasets and Arrow IPC files, used by
+FltQuery.export. The pages of an async query are written one at a time as they
+arrive, under a schema fixed up front from the types of the selected fields.
+'''
+
+formats = ('parquet', 'arrow')
+
+_arrow_types = {
+	'number': lambda: pa.float64(),
+	'discrete': lambda: pa.dictionary(pa.int32(), pa.string()),
+	'boolean': lambda: pa.bool_(),
+	'dateTime': lambda: pa.timestamp('ns', tz='UTC'),
+	'string': lambda: pa.string()
+}
+
+
+def arrow_schema(names, types, field_ids = None):
+	'''
+	Arrow schema of a query result. Numbers are always float64 so that pages of
+	integral values get the same type as the rest; discrete fields are dictionary
+	encoded. Repeated names get a ".1", ".2" ... suffix.
+	'''
+	_require_arrow()
+	fields = []
+	for i, (name, ctype) in enumerate(zip(_unique_names(names), types)):
+		meta = {'ems_type': ctype}
+		if field_ids is not None:
+			meta['ems_field_id'] = str(field_ids[i])
+		fields.append(pa.field(name, _arrow_types.get(ctype, _arrow_types['string'])(), metadata = meta))
+	return pa.schema(fields)
+
+
+class DatasetWriter(object):
+	'''
+	Writes DataFrames of a fixed schema to disk as record batches.
+
+	* "parquet": a directory of part-NNNNN.parquet files of up to rows_per_file rows,
+	  one row group per page. Readable as one dataset by pyarrow.parquet.read_table,
+	  pyarrow.dataset or pandas.read_parquet.
+	* "arrow": a single Arrow IPC file, uncompressed so that it can be memory-mapped
+	  (pyarrow.memory_map + pyarrow.ipc.open_file) without copying.
+
+	The dictionaries of discrete columns start with the values of the field and only
+	grow, so that the IPC file gets dictionary deltas rather than replacements.
+	'''
+	def __init__(self, path, schema, format = 'parquet', rows_per_file = 1000000, compression = 'snappy', dictionaries = None):
+
+		_require_arrow()
+		if format not in formats:
+			raise ValueError("Unknown export format '%s'. Use one of %s." % (format, list(formats)))
+		self.path 			= path
+		self.schema 		= schema
+		self.format 		= format
+		self.rows_per_file 	= rows_per_file
+		self.compression 	= compression
+		self.files 			= []
+		self.rows 			= 0
+		self.__writer 		= None
+		self.__file_rows 	= 0
+		self.__encoders 	= dict((i, _DictEncoder((dictionaries or dict()).get(i, [])))
+								   for i, f in enumerate(schema) if pa.types.is_dictionary(f.type))
+
+		if format == 'parquet':
+			if os.path.isdir(path) and len(os.listdir(path)) > 0:
+				raise ValueError("The export directory '%s' is not empty." % path)
+			if not os.path.isdir(path):
+				os.makedirs(path)
+
+
+	def write(self, df):
+		'''Writes a DataFrame whose columns follow the schema by position.'''
+		if df.shape[0] == 0:
+			return
+		batch = self.__to_batch(df)
+
+		if self.format == 'arrow':
+			if self.__writer is None:
+				opts = pa.ipc.IpcWriteOptions(emit_dictionary_deltas = True)
+				self.__writer = pa.ipc.new_file(self.path, self.schema, options = opts)
+				self.files.append(self.path)
+			self.__writer.write_batch(batch)
+		else:
+			if self.__writer is not None and self.__file_rows >= self.rows_per_file:
+				self.__writer.close()
+				self.__writer = None
+			if self.__writer is None:
+				fname = os.path.join(self.path, "part-%05d.parquet" % len(self.files))
+				self.__writer = pq.ParquetWriter(fname, self.schema, compression = self.compression)
+				self.files.append(fname)
+				self.__file_rows = 0
+			self.__writer.write_table(pa.Table.from_batches([batch], schema = self.schema))
+			self.__file_rows += batch.num_rows
+		self.rows += batch.num_rows
+
+
+	def close(self):
+
+		if self.__writer is None and self.format == 'arrow':
+			# No rows. Still leave a valid, empty file.
+			self.__writer = pa.ipc.new_file(self.path, self.schema)
+			self.files.append(self.path)
+		if self.__writer is not None:
+			self.__writer.close()
+			self.__writer = None
+
+
+	def __to_batch(self, df):
+
+		arrays = []
+		for i, f in enumerate(self.schema):
+			col = df.iloc[:, i]
+			try:
+				if i in self.__encoders:
+					arrays.append(self.__encoders[i].encode(col))
+				else:
+					arrays.append(pa.Array.from_pandas(col, type = f.type))
+			except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+				raise ValueError("Column '%s' could not be written as %s: %s" % (f.name, f.type, e))
+		return pa.RecordBatch.from_arrays(arrays, schema = self.schema)
+
+
+class _DictEncoder(object):
+	'''Dictionary encoding of string values against a dictionary that only grows.'''
+
+	def __init__(self, values):
+
+		self.index = pd.Index(pd.unique(pd.Series([str(v) for v in values], dtype = object)))
+
+
+	def encode(self, col):
+
+		isnull = col.isna().values
+		vals = col.astype(str).values
+		new = pd.unique(vals[~isnull])
+		new = new[self.index.get_indexer(new) < 0]
+		if len(new) > 0:
+			self.index = self.index.append(pd.Index(new))
+		codes = self.index.get_indexer(vals)
+		return pa.DictionaryArray.from_arrays(pa.array(codes, type = pa.int32(), mask = isnull),
+											  pa.array(self.index.values, type = pa.string()))
+
+
+def _unique_names(names):
+
+	seen = dict()
+	out = []
+	for n in names:
+		k = seen.get(n, 0)
+		out.append(n if k == 0 else "%s.%d" % (n, k))
+		seen[n] = k + 1
+	return out
+
+
+def _require_arrow():
+
+	if pa is None:
+		raise ImportError("Exporting query results requires pyarrow. Install it with 'pip install pyarrow'.")
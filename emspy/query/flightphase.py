@@ -9,12 +9,12 @@ class FlightPhase(Asset):
 
 		Asset.__init__(self, conn, "FlightPhase")
 		self._ems_id = ems_id
-		self.update_list()
+		self.update_list(refresh=False)
 
 
-	def update_list(self):
+	def update_list(self, refresh=True):
 
-		Asset.update_list(self, uri_keys=('flt_phase','list'), uri_args=self._ems_id)
+		Asset.update_list(self, uri_keys=('flt_phase','list'), uri_args=self._ems_id, refresh=refresh)
 		self._rename_datacol('description', 'name')
 
 
@@ -1,22 +1,44 @@
 from __future__ import print_function
 from __future__ import absolute_import
+from future import standard_library
+standard_library.install_aliases()
 from builtins import zip
 from builtins import str
 from emspy.query import *
 from .query import Query
+from . import pageconv
+from .export import DatasetWriter, arrow_schema
+from .checkpoint import AsyncCheckpoint
+from .asyncquery import AsyncQuery
+from .paging import PageSchedule
+from emspy import serializer
  
 import pandas as pd
-import sys, json
+import sys, json, socket, time, zlib, multiprocessing, urllib.error
+from http.client import HTTPException
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+try:
+	import ijson
+except ImportError:
+	ijson = None
 
-class FltQuery(Query):
 
+class FltQuery(Query):
+	# JSON backend (see emspy.serializer) decoding the query results. None is the
+	# serializer's default. "ijson" parses the async-query pages incrementally as they
+	# stream in, which holds less in memory but is slower than a whole-body decode.
+	json_backend = None
 
 	def __init__(self, conn, ems_name, data_file = None):
 
 		Query.__init__(self, conn, ems_name)
 		self._init_assets(data_file)
 		self.reset()
+		# Decisions and timings of the run planner, one dict per run. See run.
+		self.plan_log = []
 
 	
 	def _init_assets(self, data_file):
@@ -226,110 +248,487 @@ class FltQuery(Query):
 		Returned data for query in Pandas' DataFrame format
 		'''
 		print('Sending a simple query to EMS ...')
-		resp_h, content = self._conn.request(	
-			rtype="POST", 
-			uri_keys=('database','query'),
-			uri_args=(self._ems_id, self.__flight.get_database()['id']),
-			jsondata= self.__queryset
-			)	
+		resp_h, raw = self._conn.request(raw = True, **self._query_request('simple'))
+		content = self._decode(raw)
 		print('Done.')
+		self._warn_truncated(content)
 
 		if output == "raw":
 			return content
 		elif output == "dataframe":
-			return self.__to_dataframe(content)
+			return self._page_to_dataframe(content)
 		else:
 			raise ValueError("Requested an unknown output type.")
 
 
 
-	def async_run(self, n_row = 25000):
+	def async_run(self, n_row = 25000, prefetch = 2, n_proc = None, checkpoint_dir = None, max_retries = 3):
 		'''
 		Sends query to EMS API via async-query call. The async-query does not process
 		the query as a single batch for a query expecting a large data. You will have
 		to call it multiple times. This function do this multiple calls for you.
 
+		The calls are pipelined: while a page is converted to a DataFrame, the next
+		pages are already being fetched and decoded on worker threads, so the network
+		does not sit idle during the conversion. The pages past the last one that get
+		fetched ahead are dropped.
+
 		Input
 		-----
-		n_row: batch size of a single async call. Default is 25000.
+		n_row   : batch size of a single async call. Default is 25000. "auto" adapts the
+				  size of each call to the measured time and memory of the calls so far
+				  (see paging.AdaptivePageSizer, which can also be passed with other
+				  targets).
+		prefetch: number of pages fetched ahead of the one being converted. This bounds
+				  the pages held in memory at a time. 0 fetches pages one by one.
+		n_proc  : if given, the pages are decoded and typed on a pool of this many
+				  processes, and this process only assembles the typed columns. Worth it
+				  for wide results with many dateTime and discrete columns. At least
+				  n_proc pages are fetched ahead. Requires Python 3.7+. The workers are
+				  not forked, so a script using it needs the usual
+				  if __name__ == '__main__': guard of multiprocessing.
+		checkpoint_dir: if given, the query id, header and completed pages are kept in
+				  this directory. A run that fails can be started again with the same
+				  query and directory, and it resumes from the next page. If the query
+				  has expired on the server meanwhile, it is re-opened and read from the
+				  same row on, so the query should have a stable order (order_by).
+				  The checkpoint is removed when the run completes. The server-side
+				  query is left open after a failure, so that the resume can read it.
+		max_retries: times a page read that failed on a dropped connection or an
+				  expired query is retried before giving up.
 
 		Output
 		------
 		Returned data for query in Pandas' DataFrame format
 		'''
+		ckpt = None
+		n_total = 0
+		if checkpoint_dir is not None:
+			ckpt = AsyncCheckpoint(checkpoint_dir, self.__checkpoint_key())
+		if ckpt is not None and ckpt.resumable():
+			query = self.open_async(ckpt.state['query_id'], ckpt.state['header'])
+			n_total = ckpt.state['rows']
+			print("Resuming the async query from row %d." % n_total)
+		else:
+			query = self.open_async()
+			if ckpt is not None:
+				ckpt.start(query.id, query.header)
+
+		dfs = []
+		with query, closing(self.__pages(query, n_row, prefetch, n_proc, n_total, max_retries)) as pages:
+			try:
+				for dff in pages:
+					if ckpt is not None:
+						ckpt.add_page(dff, query.id)
+					else:
+						dfs.append(dff)
+					n_total += dff.shape[0]
+					print("Received up to %d rows." % n_total)
+			except Exception as e:
+				if ckpt is not None:
+					# Leave the query open on the server for the resume
+					query.keep_open = True
+					print("Reading the async query failed: %s\nThe %d rows received so far are checkpointed in '%s'. "
+						  "Run it again to resume." % (e, n_total, checkpoint_dir))
+					raise
+				print("Something's wrong (%s). Returning what has been sent so far." % e)
+
+		if ckpt is not None:
+			dfs = ckpt.load_pages()
+			ckpt.clear()
+
+		if len(dfs) == 0:
+			return None
+		print("Done.")
+		return pd.concat(dfs, ignore_index = True) if len(dfs) > 1 else dfs[0]
+
+
+	def export(self, path, format = 'parquet', n_row = 25000, prefetch = 2, n_proc = None,
+			   rows_per_file = 1000000, compression = 'snappy'):
+		'''
+		Runs the query as an async query and writes the results straight to disk, page by
+		page, instead of collecting them in a DataFrame. Only the pages in flight are held
+		in memory, so the output can be larger than RAM. Requires pyarrow.
+
+		The schema is fixed up front from the types of the selected fields: numbers are
+		float64, booleans bool, dateTimes UTC timestamps and strings strings. Discrete
+		fields are dictionary encoded, starting from the values of the field. The EMS
+		type and field id of each column are stored in the field metadata.
+
+		Input
+		-----
+		path         : output directory for "parquet", output file for "arrow"
+		format       : "parquet" writes a dataset of part-NNNNN.parquet files (one row
+					   group per page). "arrow" writes an uncompressed Arrow IPC file,
+					   which can be memory-mapped without copies:
+					   pyarrow.ipc.open_file(pyarrow.memory_map(path)).read_all()
+		n_row, prefetch, n_proc: as in async_run
+		rows_per_file: max rows of a Parquet part file. Default is 1,000,000.
+		compression  : Parquet compression codec. Default is "snappy".
+
+		Output
+		------
+		List of the files written
+		'''
+		names = [c['name'] for c in self.__columns]
+		types = self.__column_types()
+		dictionaries = dict((i, list(self.__kv_map(c['id']).values()))
+							for i, (c, t) in enumerate(zip(self.__columns, types)) if t == 'discrete')
+		writer = DatasetWriter(path, arrow_schema(names, types, [c['id'] for c in self.__columns]),
+							   format, rows_per_file, compression, dictionaries)
+
+		try:
+			with self.open_async() as query, closing(self.__pages(query, n_row, prefetch, n_proc)) as pages:
+				for dff in pages:
+					writer.write(dff)
+					print("Wrote %d rows." % writer.rows)
+		finally:
+			writer.close()
+		print("Done.")
+		return writer.files
+
+
+	def open_async(self, query_id = None, header = None):
+		'''
+		Opens the query as an async query on the server, or takes over one already open
+		with the given id and header. Returns an AsyncQuery, which closes the query on
+		the server when used as a context manager:
+
+		>> with query.open_async() as aq:
+		>>     print(aq.id)
+		'''
+		return AsyncQuery(self.__open_async, self.__close_async, query_id, header)
+
+
+	def __open_async(self):
 
 		print('Sending and opening an async-query to EMS ...', end=' ')
-		resp_h, content = self._conn.request(
-			rtype = "POST",
-			uri_keys = ('database', 'open_asyncq'),
-			uri_args = (self._ems_id, self.__flight.get_database()['id']),
-			jsondata = self.__queryset
-			)
+		resp_h, content = self._conn.request(**self._query_request('open'))
 		if 'id' not in content:
 			sys.exit("Opening Async query did not return the query Id.")
-		query_id = content['id']
-		query_header = content['header']
 		print('Done.')
+		return content['id'], content['header']
+
+
+	def __close_async(self, query_id):
+
+		self._conn.request(**self._query_request('close', query_id))
+
+
+	def __checkpoint_key(self):
+
+		return [self._ems_id, self.__flight.get_database()['id'], self.__queryset]
+
+
+	def __pages(self, query, n_row, prefetch, n_proc, start_row = 0, max_retries = 3):
+		'''
+		Generator of the pages of an open async query (an AsyncQuery) as DataFrames,
+		starting from row start_row, fetched ahead and converted as described in
+		async_run. The rows of each page are given by the page sizer of n_row at the
+		time the page is requested.
+		'''
+		schedule = PageSchedule(n_row, start_row)
+		read, to_dataframe, converter = self._page_reader(query, n_proc, max_retries)
+		if converter is not None:
+			prefetch = max(prefetch, n_proc)
+
+		fetcher = ThreadPoolExecutor(max_workers = max(1, prefetch))
+		def fetch():
+			start, end = schedule.next_page()
+			return start, end, fetcher.submit(read, start, end)
+		pages = deque(fetch() for i in range(prefetch))
 
 		ctr = 0
-		df = None
-		while True:
-			print(" === Async call: %d ===" % (ctr+1))
-			try:
-				resp_h, content = self._conn.request(
-					rtype= "GET",
-					uri_keys = ('database', 'get_asyncq'),
-					uri_args = (self._ems_id, 
-								self.__flight.get_database()['id'],
-								query_id,
-								n_row*ctr,
-								n_row*(ctr+1)-1)
-					)
-				content['header'] = query_header
-				dff = self.__to_dataframe(content)
-			except:
-				print("Something's wrong. Returning what has been sent so far.")				
-				# from pprint import pprint
-				# pprint(resp_h)
-				# pprint(content)
-				return df
-			
-			if ctr == 0:
-				df = dff
-			else:
-				df = df.append(dff, ignore_index = True)
+		try:
+			while True:
+				print(" === Async call: %d ===" % (ctr+1))
+				pages.append(fetch())
+				start, end, page = pages.popleft()
+				res, seconds = page.result()
+				dff = to_dataframe(res)
+				yield dff
+				if schedule.page_done(start, end, dff.shape[0], seconds, dff.memory_usage(index = False).sum()):
+					break
+				ctr += 1
+		finally:
+			for start, end, f in pages:
+				f.cancel()
+			fetcher.shutdown(wait = False)
+			if converter is not None:
+				converter.shutdown(wait = False)
+
+
+	def _page_reader(self, query, n_proc, max_retries):
+		'''
+		Page reading of an open async query (an AsyncQuery), shared by async_run and
+		AsyncFltQuery.async_run. Returns read(start, end), which reads a page with
+		retries and returns what it read with the seconds it took, to_dataframe, which
+		converts what read returned, and the process pool converting the pages when
+		n_proc is given (None otherwise), which the caller shuts down.
+		'''
+		converter = None
+		if n_proc is None:
+			read_page = lambda start, end: self.__read_retrying(
+				query, lambda qid: self._fetch_content(qid, start, end), max_retries)
+			to_dataframe = lambda content: self._page_to_dataframe(content, query.header)
+		else:
+			converter = self.__page_converter(n_proc)
+			names = [h['name'] for h in query.header]
+			types = self.__column_types()
+			read_page = lambda start, end: converter.submit(pageconv.convert_page, self.__read_retrying(
+				query, lambda qid: self._fetch_raw(qid, start, end), max_retries)).result()
+			to_dataframe = lambda res: pageconv.to_frame(res[1], names, types)
 
-			print("Received up to %d rows." % df.shape[0])
-			if dff.shape[0] < n_row:
-				break	
-			ctr += 1
-			
-		print("Done.")
-		return df
+		def read(start, end):
+			t0 = time.time()
+			res = read_page(start, end)
+			return res, time.time() - t0
+		return read, to_dataframe, converter
 
 
-	def run(self, n_row = 25000):
+	def run(self, n_row = 25000, prefetch = 2, n_proc = None, plan = "auto"):
 		'''
 		Sends query to EMS API. It uses either regular or async query call depending on
 		the expected size of output data. It supports only Pandas DataFrame as the output
 		format.
 
+		The regular (simple) query is one round trip but returns 25000 rows at most; the
+		async query takes an open, the page reads and a close. The planner picks:
+
+		* simple, if top is set and at most 25000;
+		* otherwise, for queries without groupBy or aggregates, it sends a count query
+		  (one row back) and runs simple if the count is below 25000, async otherwise;
+		* async for the rest. Its first page tells the size anyway.
+
+		A simple run that comes back with 25000 rows despite the count is run again as
+		async, so the result is never silently truncated. Each run adds its decision
+		and timings to plan_log.
+
 		Input
 		-----
-		n_row: batch size of a single async call. Default is 25000.
+		n_row   : batch size of a single async call. Default is 25000. "auto" adapts it
+				  to the measured cost of the calls, see async_run.
+		prefetch: pages fetched ahead by async_run. Default is 2.
+		n_proc  : number of processes converting the async pages. See async_run.
+		plan    : "auto" (default), or "simple" / "async" to force a path.
 
 		Output
 		------
 		Returned data for query in Pandas' DataFrame format
 		'''
-		Nout = None
-		if 'top' in self.__queryset:
-			Nout = self.__queryset['top']
+		path, entry = self._start_run(plan)
+		t1 = time.time()
+		df = None
+		if path == "simple":
+			df = self.simple_run(output = "dataframe")
+			path = self._after_simple(plan, df, entry, t1)
+		if path == "async":
+			df = self.async_run(n_row = n_row, prefetch = prefetch, n_proc = n_proc)
+		self._end_run(entry, path, df, t1)
+		return df
+
+
+	def _start_run(self, plan):
+		'''
+		Plans a run. Returns the execution path and the plan_log entry of the run, which
+		_after_simple and _end_run fill in.
+		'''
+		if plan not in ("auto", "simple", "async"):
+			raise ValueError("Unknown plan '%s'. Use one of %s." % (plan, ["auto", "simple", "async"]))
+		t0 = time.time()
+		path, reason, estimate = self._plan(plan)
+		entry = {'time': t0, 'plan': plan, 'path': path, 'reason': reason, 'estimate': estimate,
+				 'plan_seconds': time.time() - t0, 'fallback': False}
+		print("Query plan: %s (%s)." % (path, reason))
+		return path, entry
+
+
+	def _after_simple(self, plan, df, entry, t1):
+		'''
+		Path of a run after its simple query: "async" if the simple query hit its row
+		limit under the auto plan, "simple" otherwise. The run started at t1.
+		'''
+		entry['simple_seconds'] = time.time() - t1
+		if plan == "auto" and self._may_truncate() and df.shape[0] >= simple_query_limit:
+			print("The simple query hit its row limit. Running it as an async query instead.")
+			entry['fallback'] = True
+			return "async"
+		return "simple"
+
+
+	def _end_run(self, entry, path, df, t1):
+
+		entry.update(path = path, rows = 0 if df is None else df.shape[0], run_seconds = time.time() - t1)
+		self.plan_log.append(entry)
+
+
+	def _plan(self, plan):
+		'''Returns the execution path, the reason for it and the estimated result rows.'''
+		top = self.__queryset.get('top')
+		if plan != "auto":
+			return plan, "forced", None
+		if (top is not None) and (top <= simple_query_limit):
+			return "simple", "top <= %d" % simple_query_limit, top
+
+		qs = self.__queryset
+		if len(qs['select']) == 0 or len(qs['groupBy']) > 0 or \
+				any(s.get('aggregate', 'none') != 'none' for s in qs['select']):
+			return "async", "no count query for grouped or aggregated queries", None
+
+		n = self.__count()
+		if n is None:
+			return "async", "count query failed", None
+		if top is not None:
+			n = min(n, top)
+		if n < simple_query_limit:
+			return "simple", "count %d < %d" % (n, simple_query_limit), n
+		return "async", "count %d >= %d" % (n, simple_query_limit), n
+
+
+	def __count(self):
+		'''
+		Number of result rows by a count query over the first selected field, with the
+		same filter. It counts rows before distinct, so it can only overestimate a
+		distinct result; rows where the field is null are not counted, which the
+		truncation check of run covers.
+		'''
+		qs = dict(self.__queryset)
+		qs['select'] 	= [{'fieldId': qs['select'][0]['fieldId'], 'aggregate': 'count'}]
+		qs['orderBy'] 	= []
+		qs['distinct'] 	= False
+		qs['format'] 	= "none"
+		qs.pop('top', None)
+
+		args = self._query_request('simple')
+		args['jsondata'] = qs
+		try:
+			resp_h, content = self._conn.request(**args)
+			return int(content['rows'][0][0])
+		except (urllib.error.HTTPError, KeyError, IndexError, TypeError, ValueError) as e:
+			print("The count query failed (%s)." % e)
+			return None
+
+
+	def _warn_truncated(self, content):
+		'''Warns if a simple query result has as many rows as the simple query returns.'''
+		if self._may_truncate() and len(content.get('rows', [])) >= simple_query_limit:
+			print("Warning: the simple query returned %d rows, its limit. The result is likely truncated; "
+				  "use async_run or run instead." % simple_query_limit)
+
+
+	def _may_truncate(self):
+		'''Whether the simple query can hit its row limit, i.e. top does not keep it under.'''
+		top = self.__queryset.get('top')
+		return (top is None) or (top > simple_query_limit)
+
+
+	def _query_request(self, kind, *args):
+		'''
+		Connection.request arguments of the query calls.
+
+		Input
+		-----
+		kind: "simple" (regular query), "open" (open an async query), "page" (read rows
+			  of an async query, with args query id, start row and end row) or "close"
+			  (close an async query, with arg query id)
+		'''
+		db_id = self.__flight.get_database()['id']
+		if kind == "simple":
+			return dict(rtype = "POST", uri_keys = ('database', 'query'),
+						uri_args = (self._ems_id, db_id), jsondata = self.__queryset, idempotent = True)
+		if kind == "open":
+			return dict(rtype = "POST", uri_keys = ('database', 'open_asyncq'),
+						uri_args = (self._ems_id, db_id), jsondata = self.__queryset)
+		if kind == "page":
+			return dict(rtype = "GET", uri_keys = ('database', 'get_asyncq'),
+						uri_args = (self._ems_id, db_id) + tuple(args))
+		if kind == "close":
+			return dict(rtype = "DELETE", uri_keys = ('database', 'close_asyncq'),
+						uri_args = (self._ems_id, db_id) + tuple(args))
+		raise ValueError("Unknown query request '%s'." % kind)
+
+
+	def _page_to_dataframe(self, content, header = None):
+		'''
+		Converts a simple query result or an async-query page to a DataFrame. Async
+		pages do not carry the header so it has to be given.
+		'''
+		if header is not None:
+			content['header'] = header
+		return self.__to_dataframe(content)
+
+
+	def _decode(self, raw):
+		'''Decodes a raw query response body.'''
+		return serializer.loads(raw, _body_backend(self.json_backend))
+
+
+	def __read_retrying(self, query, read, max_retries):
+		'''
+		Runs read(query_id) for an open query. Reads cut off by the network are retried
+		with a backoff; if the query has expired on the server, it is re-opened and read
+		again with the new id. Connection already retries throttling and server errors.
+		'''
+		attempt = 0
+		while True:
+			query_id = query.id
+			try:
+				return read(query_id)
+			except urllib.error.HTTPError as e:
+				if e.code not in _expired_codes or attempt >= max_retries:
+					raise
+				print("The async query has expired on the server. Re-opening it ...")
+				query.reopen(query_id)
+			except _transient_errors as e:
+				if attempt >= max_retries:
+					raise
+				print("Reading a page failed (%s). Retrying ..." % e)
+				time.sleep(min(30, 2 ** attempt))
+			attempt += 1
+
+
+	def _fetch_raw(self, query_id, start, end):
+		'''
+		Reads rows start to end of an async query as raw (inflated) JSON bytes.
+		'''
+		resp_h, raw = self._conn.request(raw = True, **self._query_request('page', query_id, start, end))
+		return raw
+
+
+	def __column_types(self):
+
+		if self.__queryset['format'] == "display":
+			return ['string' for c in self.__columns]
+		return [c['type'] for c in self.__columns]
 
-		if (Nout is not None) and (Nout <= 25000):
-			return self.simple_run(output= "dataframe")
 
-		return self.async_run(n_row = n_row)
+	def __page_converter(self, n_proc):
+		'''
+		Process pool for pageconv.convert_page. The discrete key-value maps of the
+		selected fields are looked up here and handed to the workers once. The workers
+		are started by a forkserver (spawn where there is none) rather than forked, as
+		they start from a fetcher thread while other threads may hold locks.
+		'''
+		if sys.version_info < (3, 7):
+			raise ValueError("Page conversion on processes (n_proc) requires Python 3.7 or later.")
+		types = self.__column_types()
+		kv_maps = dict((i, self.__kv_map(c['id'])) for i, (c, t) in enumerate(zip(self.__columns, types))
+					   if t == 'discrete')
+		method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+		return ProcessPoolExecutor(max_workers = n_proc, mp_context = multiprocessing.get_context(method),
+								   initializer = pageconv.init_worker,
+								   initargs = (types, kv_maps, _body_backend(self.json_backend)))
+
+
+	def _fetch_content(self, query_id, start, end):
+		'''
+		Reads rows start to end of an async query, decoded while the page streams in
+		from the socket (see _read_page).
+		'''
+		resp_h, stream = self._conn.request(stream = True, **self._query_request('page', query_id, start, end))
+		# Closing the stream frees its request slot even if the read fails
+		with closing(stream):
+			return _read_page(stream, self.json_backend)
 
 
 	def __to_dataframe(self, json_output):
@@ -342,9 +741,14 @@ class FltQuery(Query):
 		col      = [h['name'] for h in json_output['header']]
 		coltypes = [c['type'] for c in self.__columns]
 		col_id   = [c['id'] for c in self.__columns]
-		val      = json_output['rows']
 
-		df = pd.DataFrame(data = val, columns = col)
+		if 'columns' in json_output:
+			# Page parsed into column buffers
+			cols = json_output['columns'] or [[] for c in col]
+			df = pd.DataFrame(dict(enumerate(cols)), columns = list(range(len(col))))
+			df.columns = col
+		else:
+			df = pd.DataFrame(data = json_output['rows'], columns = col)
 		
 		if df.empty: return df
 
@@ -365,40 +769,27 @@ class FltQuery(Query):
 		# I know this is crappy but it seems the best way I could find.
 		for i, cid, cname, ctype in zip(range(len(col)), col_id, col, coltypes):
 			try:
-				if ctype=='number':				
-					df.iloc[:, i] = pd.to_numeric(df.iloc[:, i])
-				elif ctype=='discrete':
-					df.iloc[:, i] = self.__key_to_val(df.iloc[:, i], cid)
-					# k_map = self.__flight.list_allvalues(field_id = cid, in_dict = True)
-					# if len(k_map) == 0:
-					# 	df[cname] = self.__get_rwy_id(cname)
-					# else:
-					# 	df = df.replace({cname: k_map})
-				elif ctype=='boolean':
-					df.iloc[:, i] = df.iloc[:, i].astype(bool)
-				elif ctype=='dateTime':
-					df.iloc[:, i] = pd.to_datetime(df.iloc[:, i]).dt.tz_localize('UTC')
+				# Same typing as the process-pool conversion in pageconv
+				kv_map = self.__kv_map(cid) if ctype=='discrete' else None
+				df.iloc[:, i] = pageconv.convert_column(df.iloc[:, i], ctype, kv_map)
+				# k_map = self.__flight.list_allvalues(field_id = cid, in_dict = True)
+				# if len(k_map) == 0:
+				# 	df[cname] = self.__get_rwy_id(cname)
+				# else:
+				# 	df = df.replace({cname: k_map})
 			except ValueError:
 				print("Somethings wrong when converting to Pandas DataFrame for column '%s' (type: %s)." % (cname, ctype))
 		print("Done.")
 		return df
 
 
-	def __key_to_val(self, ds, field_id):
-		
+	def __kv_map(self, field_id):
+		'''
+		Key-value map of a discrete field as a dict. pageconv.convert_column replaces
+		only the keys present in the data, since the map can be very large.
+		'''
 		k_map = self.__flight.list_allvalues(field_id = field_id, in_df = True)
-		
-		# Sometimes k_map is a very large table making "replace" operation 
-		# very slow. Just grap kv-maps subset that are present in the target 
-		# dataframe
-		k_map = k_map[k_map.key.isin(ds.unique())]
-		# Change k_map in dict
-		km_dict = dict()
-		for i, r in k_map.iterrows():
-			km_dict[r['key']] = r['value']
-		ds = ds.replace(km_dict)
-		
-		return ds
+		return dict(zip(k_map['key'], k_map['value']))
 		
 		
 	def __get_rwy_id(self, cname):
@@ -445,6 +836,49 @@ class FltQuery(Query):
 
 
 
+# Max rows returned by a simple (regular) query
+simple_query_limit = 25000
+
+# json_backend of incremental page parsing with ijson
+incremental_backend = "ijson"
+
+# Responses to a page read of an async query that no longer exists on the server
+_expired_codes = (404, 410)
+# Errors of reading a response, e.g. connection reset or incomplete body
+_transient_errors = (socket.error, IOError, HTTPException, EOFError, zlib.error)
+
+
+def _body_backend(backend):
+	'''Serializer backend decoding whole bodies: ijson only parses streamed pages.'''
+	return None if backend == incremental_backend else backend
+
+
+def _read_page(stream, backend = None):
+	'''
+	Decodes an async-query page from a response stream with the given serializer
+	backend. With the "ijson" backend, the rows are parsed one at a time into column
+	buffers (returned under "columns") without building the whole JSON object tree.
+	'''
+	if backend != incremental_backend:
+		return serializer.loads(stream.read(), backend)
+	if ijson is None:
+		raise ImportError("The ijson JSON backend requires ijson. Install it with 'pip install ijson'.")
+
+	try:
+		rows = ijson.items(stream, 'rows.item', use_float = True)
+	except TypeError:
+		rows = ijson.items(stream, 'rows.item')
+	cols = None
+	for row in rows:
+		if cols is None:
+			cols = [[] for v in row]
+		for c, v in zip(cols, row):
+			c.append(v)
+	return {'columns': cols}
+
+
+
+
 ## Experimental...
 
 basic_ops = {
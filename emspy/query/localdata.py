@@ -3,7 +3,7 @@ import emspy
 
 import pandas as pd
 import numpy as np
-import os, sys, re, sqlite3
+import os, sys, re, sqlite3, threading
 
 
 class LocalData(object):
@@ -11,7 +11,10 @@ class LocalData(object):
 		"fieldtree": ["ems_id", "db_id", "id", "nodetype", "type", "name", "parent_id" ],
 		"dbtree"   : ["ems_id", "id", "nodetype", "name", "parent_id"],
 	    "kvmaps"   : ["ems_id", "id", "key", "value"],
-	    "params"   : ["ems_id", "id", "name", "description", "units"]
+	    "params"   : ["ems_id", "id", "name", "description", "units"],
+	    "flt_duration": ["ems_id", "flight_record", "hours"],
+	    "profile_meta": ["ems_id", "kind", "profile_id", "version", "content"],
+	    "assets"   : ["server", "key", "fetched", "content"]
 	    }
 
 
@@ -31,7 +34,10 @@ class LocalData(object):
 
 	def __connect(self):
 
-		self._conn = sqlite3.connect(self.__dbfile)
+		# The file may be used from worker threads, e.g. when query results are converted
+		# off the main thread. Access is serialized with a lock.
+		self._lock = threading.RLock()
+		self._conn = sqlite3.connect(self.__dbfile, check_same_thread=False)
 
 
 	def __check_colnames(self, table_name, df):
@@ -45,13 +51,15 @@ class LocalData(object):
 
 	def close(self):
 
-		self._conn.close()
+		with self._lock:
+			self._conn.close()
 
 
 	def append_data(self, table_name, df):
 		
 		self.__check_colnames(table_name, df)
-		df.to_sql(table_name, self._conn, index=False, if_exists="append")
+		with self._lock:
+			df.to_sql(table_name, self._conn, index=False, if_exists="append")
 	
 
 
@@ -62,7 +70,8 @@ class LocalData(object):
 			if condition is not None:
 				q = q + " WHERE %s" % condition
 			q  = q + ";"
-			df = pd.read_sql_query(q, self._conn)
+			with self._lock:
+				df = pd.read_sql_query(q, self._conn)
 
 			# Strange columns appear. Get only the actual columns
 			return df[LocalData.table_info[table_name]]		
@@ -73,11 +82,12 @@ class LocalData(object):
 	def delete_data(self, table_name, condition = None):
 
 		if self.table_exists(table_name):
-			if condition is None:
-				self._conn.execute("DROP TABLE %s" % table_name)
-			else:
-				self._conn.execute("DELETE FROM %s WHERE %s;" % (table_name, condition))
-			self._conn.commit()
+			with self._lock:
+				if condition is None:
+					self._conn.execute("DROP TABLE %s" % table_name)
+				else:
+					self._conn.execute("DELETE FROM %s WHERE %s;" % (table_name, condition))
+				self._conn.commit()
 
 
 	def delete_all_tables(self):
@@ -90,9 +100,10 @@ class LocalData(object):
 
 	def table_exists(self, table_name):
 
-		cursor = self._conn.cursor()
-		cursor.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")
-		tables = [t[0] for t in cursor.fetchall()]
+		with self._lock:
+			cursor = self._conn.cursor()
+			cursor.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")
+			tables = [t[0] for t in cursor.fetchall()]
 		return table_name in tables
 
 
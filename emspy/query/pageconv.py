@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+import numpy as np
+import pandas as pd
+
+from emspy import serializer
+
+try:
+	import pyarrow as pa
+except ImportError:
+	pa = None
+
+'''
+Typing of flight query results. FltQuery converts pages with convert_column in its own
+process; for wide results it can instead hand the raw page bytes to a process pool
+running convert_page, which returns typed column buffers. Arrow IPC is used for the
+buffers when pyarrow is installed, so that string columns do not go through pickle;
+otherwise they are numpy arrays. The parent only assembles them with to_frame.
+'''
+
+
+def convert_column(s, ctype, kv_map = None):
+	'''
+	Casts a Series of raw query values to the type of its field. Discrete keys are
+	replaced with their values in kv_map.
+	'''
+	if ctype == 'number':
+		return pd.to_numeric(s)
+	if ctype == 'discrete':
+		if not kv_map:
+			return s
+		return s.replace(dict((k, kv_map[k]) for k in s.unique() if k in kv_map))
+	if ctype == 'boolean':
+		return s.astype(bool)
+	if ctype == 'dateTime':
+		return pd.to_datetime(s).dt.tz_localize('UTC')
+	return s
+
+
+def convert_columns(cols, types, kv_maps, names = None):
+	'''
+	Converts columns (lists or Series of raw values) in place. A column that fails to
+	convert is left as is.
+	'''
+	for i, ctype in enumerate(types):
+		cols[i] = pd.Series(cols[i])
+		try:
+			cols[i] = convert_column(cols[i], ctype, kv_maps.get(i))
+		except ValueError:
+			print("Somethings wrong when converting to Pandas DataFrame for column '%s' (type: %s)." %
+				  (names[i] if names is not None else i, ctype))
+	return cols
+
+
+# State of a worker process, set once by init_worker
+_worker = dict()
+
+def init_worker(types, kv_maps, backend = None, use_arrow = True):
+	'''
+	Process pool initializer. The field types and discrete key-value maps are sent to
+	each worker once instead of with every page.
+	'''
+	_worker.update(types = types, kv_maps = kv_maps, backend = backend, use_arrow = use_arrow and pa is not None)
+
+
+def convert_page(raw):
+	'''
+	Decodes and types the raw bytes of an async-query page in a worker process. Returns
+	the number of rows and the typed columns, as Arrow IPC bytes or a list of numpy
+	arrays.
+	'''
+	rows  = serializer.loads(raw, _worker['backend'])['rows']
+	types = _worker['types']
+	cols  = [list(c) for c in zip(*rows)] if len(rows) > 0 else [[] for t in types]
+	cols  = convert_columns(cols, types, _worker['kv_maps'])
+
+	if _worker['use_arrow']:
+		try:
+			batch = pa.RecordBatch.from_arrays([pa.Array.from_pandas(c) for c in cols],
+											   [str(i) for i in range(len(cols))])
+			sink = pa.BufferOutputStream()
+			writer = pa.ipc.new_stream(sink, batch.schema)
+			writer.write_batch(batch)
+			writer.close()
+			return len(rows), sink.getvalue().to_pybytes()
+		except (pa.ArrowInvalid, pa.ArrowTypeError):
+			# Mixed-type column, e.g. discrete keys without a value. Send numpy buffers.
+			pass
+	# Timezone-aware datetimes go as UTC datetime64 and are localized again by to_frame
+	return len(rows), [c.dt.tz_localize(None).values if hasattr(c, 'dt') and getattr(c.dt, 'tz', None) is not None
+					   else np.asarray(c) for c in cols]
+
+
+def to_frame(buffers, names, types):
+	'''
+	Assembles the typed column buffers returned by convert_page into a DataFrame.
+	'''
+	if isinstance(buffers, bytes):
+		df = pa.ipc.open_stream(buffers).read_all().to_pandas()
+		df.columns = names
+		return df
+
+	cols = dict()
+	for i, (b, ctype) in enumerate(zip(buffers, types)):
+		s = pd.Series(b)
+		if ctype == 'dateTime' and s.dtype.kind == 'M':
+			s = s.dt.tz_localize('UTC')
+		cols[i] = s
+	# Positional keys, since column names may repeat
+	df = pd.DataFrame(cols, columns = list(range(len(names))))
+	df.columns = names
+	return df
@@ -0,0 +1,116 @@
+from __future__ import division
+from builtins import object
+
+'''
+Page sizes of async-query reads. FltQuery.async_run and AsyncFltQuery.async_run take
+the row ranges of their pages from a PageSchedule, which asks a sizer for the number
+of rows of each page and reports back how long each page took and how big it was.
+'''
+
+# Max rows of a single async-query read accepted by the EMS API
+max_page_rows = 25000
+
+
+class PageSizer(object):
+	'''Fixed page size.'''
+
+	def __init__(self, n_row = max_page_rows):
+
+		self.n_row 		= int(n_row)
+		self.history 	= []
+
+
+	def next_size(self):
+
+		return self.n_row
+
+
+	def update(self, rows, seconds, nbytes):
+		'''Records a page of the given rows that took seconds to read and nbytes in memory.'''
+		self.history.append((rows, seconds, nbytes))
+
+
+class AdaptivePageSizer(PageSizer):
+	'''
+	Page size adapted to the measured cost of the pages so far. Each page is sized to
+	take about target_latency seconds to read and decode, and to take at most
+	max_bytes once converted, within min_rows and max_rows. The per-row time and size
+	are smoothed over the pages, and the size changes by at most a factor of two from
+	one page to the next.
+
+	Narrow results get pages as large as allowed; very wide ones get smaller pages that
+	are quicker to parse and lighter on memory. The rows, their order and their types
+	are the same whatever the page sizes.
+	'''
+	def __init__(self, target_latency = 5.0, max_bytes = 256 * 2**20, min_rows = 1000,
+				 max_rows = max_page_rows, start_rows = None):
+
+		PageSizer.__init__(self, start_rows if start_rows is not None else max_rows)
+		self.target_latency = target_latency
+		self.max_bytes 		= max_bytes
+		self.min_rows 		= min_rows
+		self.max_rows 		= max_rows
+		self.__sec_per_row 	= None
+		self.__bytes_per_row = None
+
+
+	def update(self, rows, seconds, nbytes):
+
+		PageSizer.update(self, rows, seconds, nbytes)
+		if rows == 0:
+			return
+		self.__sec_per_row 	= _smooth(self.__sec_per_row, seconds / rows)
+		self.__bytes_per_row = _smooth(self.__bytes_per_row, nbytes / rows)
+
+		target = self.max_rows
+		if self.__sec_per_row > 0:
+			target = min(target, self.target_latency / self.__sec_per_row)
+		if self.__bytes_per_row > 0:
+			target = min(target, self.max_bytes / self.__bytes_per_row)
+		target = min(max(target, self.n_row / 2), self.n_row * 2)
+		self.n_row = int(min(max(target, self.min_rows), self.max_rows))
+
+
+def page_sizer(n_row):
+	'''
+	Page sizer of the n_row argument of async_run: a number of rows, "auto" or a
+	PageSizer.
+	'''
+	if isinstance(n_row, PageSizer):
+		return n_row
+	if n_row == 'auto':
+		return AdaptivePageSizer()
+	return PageSizer(n_row)
+
+
+class PageSchedule(object):
+	'''
+	Row ranges of the pages of an async query, from start_row on, sized by the page
+	sizer of n_row at the time each page is requested. Pages can be requested ahead of
+	the ones read; the first page that comes back short is the last one.
+	'''
+	def __init__(self, n_row, start_row = 0):
+
+		self.sizer 		= page_sizer(n_row)
+		self.next_row 	= start_row
+
+
+	def next_page(self):
+		'''Returns the first and last rows of the next page.'''
+		start = self.next_row
+		self.next_row += self.sizer.next_size()
+		return start, self.next_row - 1
+
+
+	def page_done(self, start, end, rows, seconds, nbytes):
+		'''
+		Records the page of rows start to end, which returned the given rows in seconds
+		and took nbytes in memory. Returns whether it was the last page.
+		'''
+		self.sizer.update(rows, seconds, nbytes)
+		return rows < end - start + 1
+
+
+def _smooth(avg, x, alpha = 0.5):
+
+	return x if avg is None else (1 - alpha) * avg + alpha * x
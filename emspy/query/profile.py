@@ -1,5 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
 import pandas as pd
 from .query import Query
+from .localdata import LocalData
+
+try:
+    from pandas import json_normalize
+except ImportError:
+    from pandas.io.json import json_normalize
 
 '''
 A class for profile queries using the EMS REST API
@@ -7,7 +15,13 @@ A class for profile queries using the EMS REST API
 
 
 class Profile(Query):
-    def __init__(self, conn, ems_name, profile_number, profile_name=''):
+    '''
+    The glossary and events glossary are cached in the local data file, keyed by the profile's current version.
+    The profile search is sent every time, since it is what tells the current version, so the glossaries are
+    fetched again exactly when the version changes. Pass refresh=True to drop the cached glossaries and fetch
+    them once more; later calls read them from the cache again.
+    '''
+    def __init__(self, conn, ems_name, profile_number, profile_name='', data_file=None, refresh=False):
         Query.__init__(self, conn, ems_name)
         self._conn = conn
         self._ems_name = ems_name
@@ -17,17 +31,20 @@ class Profile(Query):
         self._events_glossary = None
         self._input_profile_name = profile_name
         self._ems_id = self.get_ems_id()
+        self._metadata = LocalData(data_file)
+        self._refresh = refresh
+        # (kind, profile id) of the cached requests already refreshed by this object
+        self._refreshed = set()
         self._search()
 
     def get_glossary(self):
         if self._guid is not None:
-            resp_h, dict_data = self._conn.request(uri_keys=('profile', 'glossary'),
-                                                   uri_args=(self._ems_id, self._guid))
-            a = pd.DataFrame.from_dict(dict_data)
-            # convert the dictionaries values within the glossaryItems column of a into a new DataFrame
-            b = a['glossaryItems'].apply(pd.Series)
-            # concatenate a and b, drop the old glossaryItems column name
-            c = pd.concat([a, b], axis=1).drop('glossaryItems', axis=1)
+            dict_data = self._cached_request('glossary', self._guid, self._current_version, self._refresh,
+                                             uri_keys=('profile', 'glossary'), uri_args=(self._ems_id, self._guid))
+            # flatten the glossaryItems into columns, and repeat the profile-level values on each item row
+            b = json_normalize(dict_data['glossaryItems'])
+            meta = [k for k in dict_data if k != 'glossaryItems' and k not in b.columns]
+            c = b.assign(**dict((k, dict_data[k]) for k in meta))[meta + list(b.columns)]
             self._glossary = c
             return self._glossary
         else:
@@ -37,8 +54,8 @@ class Profile(Query):
 
     def get_events_glossary(self):
         if self._guid is not None:
-            resp_h, dict_data = self._conn.request(uri_keys=('profile', 'events'),
-                                                   uri_args=(self._ems_id, self._guid))
+            dict_data = self._cached_request('events', self._guid, self._current_version, self._refresh,
+                                             uri_keys=('profile', 'events'), uri_args=(self._ems_id, self._guid))
             a = pd.DataFrame(dict_data)
             a.set_index('id', inplace=True)
             self._events_glossary = a
@@ -48,24 +65,74 @@ class Profile(Query):
                   "system.  Please try to instantiate the profile object with different arguments.")
             return
 
-    def get_profile_results(self, flight_id):
-        raise NotImplementedError
-        if self._guid is not None:
-            resp_h, dict_data = self._conn.request(uri_keys=('profile', 'profile_results'),
-                                                   uri_args=(self._ems_id, flight_id, self._guid))
-            '''
-            TODO: Implement some sort of parsing of resulting data.  Honestly, it's not super useful unless paired
-            with some supplementary information.  There are no names.  No descriptions.  Perhaps I could combine this
-            information with the information obtained in the "glossary" and create a meaningful output.   
-            
-            Glossary, however, does not contain the names and ID's of events.  Maybe those will have to be grabbed using
-            the other API endpoints.  
-            '''
-        else:
+    def get_profile_results(self, flight_ids, n_workers=8):
+        '''
+        Fetches the profile results of many flights concurrently and returns them as one long-format
+        DataFrame, with one row per measurement or timepoint value. Flight-level values have no event
+        type; event values carry the event type and the index of the event within the flight. The names
+        and units of the items come from the profile glossary, and event names from the events glossary.
+        Both glossaries are fetched once and reused.
+        '''
+        if self._guid is None:
             print("The search results did not return a profile matching the input profile name and number on the given"
                   "system.  Please try to instantiate the profile object with different arguments.")
             return
 
+        if not hasattr(flight_ids, '__len__'):
+            flight_ids = [flight_ids]
+        flight_ids = [int(f) for f in flight_ids]
+
+        def fetch(flight_id):
+            resp_h, dict_data = self._conn.request(uri_keys=('profile', 'profile_results'),
+                                                   uri_args=(self._ems_id, flight_id, self._guid))
+            return dict_data
+
+        with ThreadPoolExecutor(max_workers=max(1, min(n_workers, len(flight_ids)))) as ex:
+            results = list(ex.map(fetch, flight_ids))
+
+        cols = ['flight_id', 'event_type', 'event_index', 'recordType', 'itemId', 'value']
+        rows = []
+        for flight_id, res in zip(flight_ids, results):
+            rows += _result_rows(flight_id, None, None, res)
+            for k, ev in enumerate(res.get('events', [])):
+                rows += _result_rows(flight_id, ev.get('eventType'), k, ev)
+        out = pd.DataFrame(rows, columns=cols)
+
+        glossary = self._glossary if self._glossary is not None else self.get_glossary()
+        keys = [k for k in ('recordType', 'itemId') if k in glossary.columns]
+        if 'itemId' in keys:
+            g = glossary.drop_duplicates(keys)
+            if 'recordType' in keys:
+                g = g.assign(recordType=g['recordType'].str.lower())
+            out = out.merge(g[keys + [c for c in ('name', 'units') if c in g.columns]], on=keys, how='left')
+
+        events = self._events_glossary if self._events_glossary is not None else self.get_events_glossary()
+        if 'name' in events.columns:
+            out['event_name'] = out['event_type'].map(events['name'])
+        return out
+
+    def _cached_request(self, kind, key, version, refresh=False, **kwargs):
+        '''
+        Returns the content of a profile metadata request from the local data file if it is there for the given
+        key and version. Otherwise requests it from the API and replaces any other cached version. With refresh,
+        the cached content is dropped the first time this object asks for it, so that it is fetched once more.
+        '''
+        key, version = _sql_str(key), _sql_str(version)
+        cond = "ems_id = %d AND kind = '%s' AND profile_id = '%s'" % (self._ems_id, kind, key)
+        if refresh and (kind, key) not in self._refreshed:
+            self._metadata.delete_data('profile_meta', cond)
+            self._refreshed.add((kind, key))
+        cached = self._metadata.get_data('profile_meta', cond + " AND version = '%s'" % version)
+        if len(cached) > 0:
+            return json.loads(cached['content'].values[0])
+
+        resp_h, dict_data = self._conn.request(**kwargs)
+        self._metadata.delete_data('profile_meta', cond)
+        self._metadata.append_data('profile_meta', pd.DataFrame([{'ems_id': self._ems_id, 'kind': kind,
+                                                                  'profile_id': key, 'version': version,
+                                                                  'content': json.dumps(dict_data)}]))
+        return dict_data
+
     def _search(self):
         resp_h, dict_data = self._conn.request(uri_keys=('profile', 'search'), uri_args=self._ems_id,
                                                body={'search': self._input_profile_name})
@@ -87,3 +154,13 @@ class Profile(Query):
                 ' take longer).')
         elif len(filtered > 1):
             print('Somehow found multiple profiles with the supplied name and number.')
+
+
+def _result_rows(flight_id, event_type, event_index, res):
+    return [(flight_id, event_type, event_index, rtype, x.get('itemId'), x.get('value'))
+            for rtype, key in (('measure', 'measures'), ('timepoint', 'timepoints'))
+            for x in res.get(key, [])]
+
+
+def _sql_str(x):
+    return str(x).replace("'", "''")
@@ -0,0 +1,120 @@
+from builtins import object
+from .localdata import LocalData
+
+import pandas as pd
+import threading, weakref, json, time
+
+
+class AssetRegistry(object):
+	'''
+	Process-wide, thread-safe store of EMS asset lists (EMS systems, fleets, aircraft,
+	airports, flight phases). Each list is requested from the API at most once per
+	connection and then shared by all the query and asset objects using that connection.
+	Optionally the lists are also persisted to a local data file, per server and user,
+	so that new processes can skip the API calls while the stored lists are younger than
+	a given TTL.
+	'''
+
+	def __init__(self):
+
+		self._lock      = threading.Lock()
+		self._lists     = weakref.WeakKeyDictionary()
+		self._data_file = None
+		self._ttl       = None
+		self._enabled   = False
+
+
+	def persist(self, data_file = None, ttl = 24 * 60 * 60):
+		'''
+		Turns on the persistence of asset lists to the local data file.
+
+		Input
+		-----
+		data_file: local data file name. The default file is used if not given.
+		ttl      : max age in seconds of a persisted list to be reused. Default is a day.
+		'''
+		self._data_file = data_file
+		self._ttl       = ttl
+		self._enabled   = True
+
+
+	def get(self, conn, uri_keys, uri_args = None, body = None, refresh = False):
+		'''
+		Returns the decoded API content for an asset list request. The request is sent
+		only if the list has not been loaded yet, or refresh = True.
+		'''
+		if uri_args is not None and type(uri_args) not in (list, tuple):
+			uri_args = (uri_args,)
+		key = (tuple(uri_keys), None if uri_args is None else tuple(uri_args),
+			   None if body is None else json.dumps(body, sort_keys = True))
+
+		with self._lock:
+			entries = self._lists.setdefault(conn, dict())
+			if key not in entries:
+				entries[key] = {'lock': threading.Lock(), 'content': None}
+			entry = entries[key]
+
+		# Callers asking for the same list wait for a single load
+		with entry['lock']:
+			if refresh or entry['content'] is None:
+				content = None if refresh else self.__load(conn, key)
+				if content is None:
+					resp_h, content = conn.request(uri_keys = uri_keys, uri_args = uri_args, body = body)
+					self.__save(conn, key, content)
+				entry['content'] = content
+			return entry['content']
+
+
+	def clear(self, conn = None):
+		'''
+		Forgets the loaded asset lists of a connection, or of all connections.
+		'''
+		with self._lock:
+			if conn is None:
+				self._lists.clear()
+			else:
+				self._lists.pop(conn, None)
+
+
+	def __record_key(self, conn, key):
+
+		# Users of the same server may see different assets
+		return conn.get_uri_root(), json.dumps([conn.get_user()] + list(key))
+
+
+	def __load(self, conn, key):
+
+		if not self._enabled:
+			return None
+		server, k = self.__record_key(conn, key)
+		ld = LocalData(self._data_file)
+		try:
+			df = ld.get_data("assets", "server = '%s' AND key = '%s' AND fetched >= %f" % (
+				_sql_str(server), _sql_str(k), time.time() - self._ttl))
+		finally:
+			ld.close()
+		if len(df) == 0:
+			return None
+		return json.loads(df['content'].values[-1])
+
+
+	def __save(self, conn, key, content):
+
+		if not self._enabled:
+			return
+		server, k = self.__record_key(conn, key)
+		ld = LocalData(self._data_file)
+		try:
+			ld.delete_data("assets", "server = '%s' AND key = '%s'" % (_sql_str(server), _sql_str(k)))
+			ld.append_data("assets", pd.DataFrame([{'server': server, 'key': k, 'fetched': time.time(),
+													'content': json.dumps(content)}]))
+		finally:
+			ld.close()
+
+
+def _sql_str(x):
+	return x.replace("'", "''")
+
+
+# The registry shared by everything in this process
+shared_assets = AssetRegistry()
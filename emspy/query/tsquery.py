@@ -4,9 +4,13 @@ from future import standard_library
 standard_library.install_aliases()
 from emspy.query import *
 from .query import Query
+from .derived import DerivedParam, Batch, apply_derived
+from . import exceedance
 
+from concurrent.futures import ThreadPoolExecutor
 import pickle
 import warnings
+import sys
 import pandas as pd
 import numpy as np
 
@@ -31,36 +35,90 @@ class TSeriesQuery(Query):
 
         self.__columns  = list()
         self.__queryset = {'select':[]}
+        self.__derived  = list()
+        # Columns fetched only as inputs of derived parameters
+        self.__hidden   = list()
 
 
     def select(self, *args):
 
-        keywords   = args
-        save_table = False
-
-        for kw in keywords:
-            # Get the param from param table
-            prm = self.__analytic.get_param(kw)
-            if prm['id'] == "":
-                # If the param's not found, call EMS API
-                res_df = self.__analytic.search_param(kw, in_df = True)
-                res_df['ems_id'] = self._ems_id
-                # The first one is with the shortest name string. Pick that.
-                prm = res_df.iloc[0,:].to_dict()
-                # Add the new parameters to the param table for later uses
-                self.__analytic._param_table = self.__analytic._param_table.append(res_df, ignore_index = True)
-                save_table = True
+        for prm in self.__resolve(args):
+            if prm['name'] in self.__hidden:
+                # Already fetched for a derived parameter. Just stop hiding it.
+                self.__hidden.remove(prm['name'])
+                continue
 
             # Put the param into JSON query string
             self.__queryset['select'].append({'analyticId': prm['id']})
             # Just in case you want to check what params are selected
             self.__columns.append(prm)
-        if save_table:
-            self.__analytic._save_paramtable()
+
+
+    def __resolve(self, keywords):
+
+        # Search EMS for all the keywords that are not in the param table in one batch
+        missing  = [kw for kw in keywords if self.__analytic.get_param(kw)['id'] == ""]
+        searched = self.__analytic.search_params(missing)
+
+        prms = []
+        for kw in keywords:
+            if kw in searched:
+                # The first one is with the shortest name string. Pick that.
+                prms.append(searched[kw][0])
+            else:
+                # Get the param from param table
+                prms.append(self.__analytic.get_param(kw))
+        return prms
+
+
+    def derive(self, name, expr, **inputs):
+        '''
+        Defines a derived parameter computed from the time series of other parameters.
+        The expression is compiled once and evaluated over all flights of a run or
+        multi_run at once. Input parameters that are not selected yet are fetched
+        automatically but left out of the output data.
+
+        Input
+        -----
+        name  : column name of the derived parameter
+        expr  : numpy expression of the input variables. Besides numpy ("np"), it can use
+                rate(x), smooth(x, n), shift(x, n) and between(x, lo, hi), which work
+                within each flight.
+        inputs: variable name = param keyword (or the name of an earlier derived parameter)
+
+        Example
+        -------
+        >> tsq.derive("descent rate (ft/min)", "-60 * rate(alt)", alt = "baro-corrected altitude")
+        >> tsq.derive("low and fast", "(alt < 1000) & (smooth(cas, 5) > 200)",
+                      alt = "baro-corrected altitude", cas = "airspeed (calibrated; 1 or only)")
+        '''
+        derived_names = [d.name for d in self.__derived]
+        params = [kw for kw in inputs.values() if kw not in derived_names]
+        cols   = dict(zip(params, self.__resolve(params)))
+
+        selected = [c['id'] for c in self.__columns]
+        for prm in cols.values():
+            if prm['id'] not in selected:
+                self.__queryset['select'].append({'analyticId': prm['id']})
+                self.__columns.append(prm)
+                self.__hidden.append(prm['name'])
+                selected.append(prm['id'])
+
+        inputs = dict((var, kw if kw in derived_names else cols[kw]['name']) for var, kw in inputs.items())
+        self.__derived.append(DerivedParam(name, expr, inputs))
+
+
+    def build_catalog(self, n_workers = 8):
+        '''
+        Loads all analytics of the EMS system into the local param table so that later
+        selects need no API calls.
+        '''
+        return self.__analytic.build_catalog(n_workers = n_workers)
 
 
     def range(self, start = None, end = None):
 
+        self.__queryset.pop('offsets', None)
         self.__queryset['start'] = start
         self.__queryset['end']   = end
 
@@ -68,24 +126,53 @@ class TSeriesQuery(Query):
     def timepoint(self, tpoint):
         if type(tpoint) == np.ndarray:
             tpoint = tpoint.tolist()
+        self.__queryset.pop('start', None)
+        self.__queryset.pop('end', None)
         self.__queryset['offsets'] = tpoint
 
 
-    def run(self, flight, start = None, end = None, timestep = None, timepoint = None):
+    def run(self, flight, start = None, end = None, timestep = None, timepoint = None, window = None, n_workers = 4):
+        '''
+        Sends the time-series query for a single flight.
+
+        Input
+        -----
+        window   : optional window size in seconds. When given, the requested time range (or
+                   time points) is split into windows of this length that are fetched
+                   concurrently and stitched back into one DataFrame. Useful for long flights
+                   at high sample rates. A range without an end time is not split.
+        n_workers: max number of windows being fetched at the same time. Default is 4.
+
+        Output
+        ------
+        Pandas DataFrame with the time offsets and values of the selected and derived
+        parameters
+        '''
+        df = self.__run(flight, start, end, timestep, timepoint, window, n_workers)
+        return self._apply_derived([df])[0]
+
+
+    def __run(self, flight, start, end, timestep, timepoint, window, n_workers):
 
-        # if start is None:
-        #     start = 0.0
+        qs = self._timeframe(start, end, timestep, timepoint)
 
-        # if end is None:
-        #     end = self.flight_duration(flight)
+        if window is None:
+            return self.__fetch(flight, qs)
 
-        # if timestep is not None:
-        #     timepoint = np.arange(start, end, timestep)
+        querysets = self._split_windows(qs, window)
+        if len(querysets) == 1:
+            return self.__fetch(flight, querysets[0])
 
-        # if timepoint is not None:
-        #     self.timepoint(timepoint)
-        # else:
-        #     self.range(start, end)
+        with ThreadPoolExecutor(max_workers = min(n_workers, len(querysets))) as ex:
+            dfs = list(ex.map(lambda q: self.__fetch(flight, q), querysets))
+        return self._stitch(qs, dfs)
+
+
+    def _timeframe(self, start, end, timestep, timepoint):
+        '''
+        Sets the time range or time points of the query, and returns a copy of the
+        resulting queryset.
+        '''
         if timepoint is not None:
             self.timepoint(timepoint)
 
@@ -100,9 +187,53 @@ class TSeriesQuery(Query):
         else:
             self.range(start, end)
 
-        resp_h, content = self._conn.request( uri_keys = ("analytic", "query"),
-                                              uri_args = (self._ems_id, flight),
-                                              jsondata = self.__queryset)
+        return dict(self.__queryset)
+
+
+    def _split_windows(self, qs, window):
+        '''
+        Splits the time range or time points of a queryset into querysets covering at
+        most `window` seconds each.
+        '''
+        if window <= 0:
+            raise ValueError("Window size should be a positive number of seconds.")
+
+        if 'offsets' in qs:
+            offsets = np.asarray(qs['offsets'], dtype = float)
+            if offsets.size == 0:
+                return [qs]
+            bins   = np.floor((offsets - offsets[0]) / window).astype(int)
+            splits = np.flatnonzero(np.diff(bins)) + 1
+            return [{'select': qs['select'], 'offsets': o.tolist()} for o in np.split(offsets, splits)]
+
+        start, end = qs.get('start'), qs.get('end')
+        if end is None:
+            return [qs]
+        start = 0.0 if start is None else start
+        edges = np.arange(start, end, window).tolist() + [end]
+        return [{'select': qs['select'], 'start': s, 'end': e} for s, e in zip(edges[:-1], edges[1:])]
+
+
+    def _stitch(self, qs, dfs):
+
+        # Adjacent range windows share their boundary sample. Keep it only once.
+        t_col = "Time (sec)"
+        for i in range(1, len(dfs)):
+            if ('offsets' not in qs) and (not dfs[i-1].empty):
+                dfs[i] = dfs[i][dfs[i][t_col] > dfs[i-1][t_col].iloc[-1]]
+        return pd.concat(dfs, ignore_index = True)
+
+
+    def _ts_request(self, flight, queryset):
+        '''
+        Connection.request arguments of the time-series query of a flight.
+        '''
+        return dict(rtype = "POST", uri_keys = ("analytic", "query"),
+                    uri_args = (self._ems_id, flight),
+                    jsondata = queryset, idempotent = True)
+
+
+    def _ts_dataframe(self, flight, content):
 
         if 'message' in content:
             sys.exit('API query for flight %d was unsuccessful.\nHere is the message from API: %s' % (flight, content['message']))
@@ -117,76 +248,172 @@ class TSeriesQuery(Query):
         return df
 
 
+    def __fetch(self, flight, queryset):
+
+        resp_h, content = self._conn.request(**self._ts_request(flight, queryset))
+        return self._ts_dataframe(flight, content)
+
 
-    def multi_run(self, flight, start = None, end = None, timestep=None, timepoint = None, save_file = None, verbose = True):
+    def _apply_derived(self, dfs):
 
-        res       = list()
-        attr_flag = False
+        return apply_derived(dfs, self.__derived, self.__hidden)
+
+
+    def _multi_args(self, flight, start, end, timestep, timepoint):
+        '''
+        Expands the multi_run inputs into per-flight lists. Returns the Flight Records,
+        the flight data of each flight, and the start, end and timestep lists.
+        '''
         if isinstance(flight, pd.DataFrame):
             FR = flight["Flight Record"]
-            attr_flag = True
+            flt_data = [flight.iloc[i,:].to_dict() for i in range(len(FR))]
         else:
             FR = flight
+            flt_data = [{'Flight Record': fr} for fr in FR]
 
         # param processing
-        if start is None:       start       = [None]*len(FR)
-        if end   is None:       end         = [None]*len(FR)
         if not hasattr(timestep, "__len__"):
             timestep = [timestep]*len(FR)
-        if timepoint is None:   
-            timepoint   = [None]*len(FR)
-        else: 
+        if (end is None) and any(t is not None for t in timestep):
+            # Time grids need the end times. Look them up for all flights at once.
+            end = self.flight_durations(FR).tolist()
+        if start is None:       start       = [None]*len(FR)
+        if end   is None:       end         = [None]*len(FR)
+        if timepoint is not None:
             warnings.warn("Time points are not yet supported. The given time points will be ignored.")
-            timepoint   = [None]*len(FR)
+        return FR, flt_data, start, end, timestep
+
+
+    def multi_run(self, flight, start = None, end = None, timestep=None, timepoint = None, save_file = None, verbose = True, window = None):
+
+        res = list()
+        FR, flt_data, start, end, timestep = self._multi_args(flight, start, end, timestep, timepoint)
             
         if verbose: print('\n=== Start running time-series data querying for %d flights ===\n' % len(FR))
         
         for i, fr in enumerate(FR):
             if verbose: print('\r\x1b[K%d / %d: FR %d' % (i+1, len(FR), fr), end=' ')
             i_res = dict()
-            if attr_flag:
-                i_res['flt_data'] = flight.iloc[i,:].to_dict()
-            else:
-                i_res['flt_data'] = {'Flight Record': fr}
-            i_res['ts_data'] = self.run(fr, start[i], end[i], timestep[i])
+            i_res['flt_data'] = flt_data[i]
+            i_res['ts_data'] = self.__run(fr, start[i], end[i], timestep[i], None, window, 4)
             res.append(i_res)
 
             if save_file is not None:
                 pickle.dump(res, open(save_file, 'wb'))
+
+        # Derived parameters are evaluated for all flights in one batch
+        if len(self.__derived) + len(self.__hidden) > 0:
+            self._apply_derived([r['ts_data'] for r in res])
+            if save_file is not None:
+                pickle.dump(res, open(save_file, 'wb'))
         if verbose: print('Done')
 
         return res
 
 
+    def scan_exceedances(self, res, condition, min_duration = 0, measure = None, **inputs):
+        '''
+        Finds the time intervals where a condition holds, across all flights of a
+        multi_run result at once.
+
+        Input
+        -----
+        res         : output of multi_run, or a single DataFrame returned by run
+        condition   : name of a boolean column in the data (e.g. a derived parameter), or
+                      an expression in the syntax of derive with variables given in inputs
+        min_duration: minimum length of an interval in seconds. Default is 0.
+        measure     : optional column name whose min/max within each interval are reported
+        inputs      : variable name = column name of the data
+
+        Output
+        ------
+        Pandas DataFrame with one row per interval: Flight Record, start/end time,
+        duration and number of samples
+
+        Example
+        -------
+        >> tsq.scan_exceedances(res, "(alt < 1000) & (vs < -1000)", min_duration = 5,
+                                alt = "Baro-Corrected Altitude (ft)", vs = "descent rate (ft/min)")
+        '''
+        if isinstance(res, pd.DataFrame):
+            dfs, labels = [res], None
+        else:
+            dfs    = [r['ts_data'] for r in res]
+            labels = [r['flt_data']['Flight Record'] for r in res]
+
+        batch = Batch(dfs)
+        if condition in batch.frame.columns:
+            mask = batch.frame[condition].values
+        else:
+            mask = DerivedParam("condition", condition, inputs).evaluate(batch)
+        return exceedance.scan(batch, mask, min_duration, measure, labels)
+
+
     def flight_duration(self, flight, unit = "second"):
         '''
-        deprecated
+        Returns the length of recorded data for a single flight. See flight_durations for
+        looking up many flights at once.
         '''
+        return self.flight_durations([flight], unit = unit)[0]
+
+
+    def flight_durations(self, flights, unit = "second", n_workers = 8):
+        '''
+        Returns the lengths of recorded data ("hours of data") for a list of Flight Records.
+        Durations already in the local data file are reused. The missing ones are queried
+        concurrently and then saved to the local data file in a single write.
+
+        Input
+        -----
+        flights  : list-like of Flight Records
+        unit     : "second" (default), "minute" or "hour"
+        n_workers: max number of concurrent analytic calls. Default is 8.
+
+        Output
+        ------
+        numpy array of durations in the order of the given flights
+        '''
+        factor = {"second": 60 * 60, "minute": 60, "hour": 1}
+        if unit not in factor:
+            sys.exit("Unrecognizable time unit (%s)." % unit)
+
+        flights = [int(f) for f in flights]
+        ld      = self.__analytic._metadata
+        cached  = ld.get_data("flt_duration", "ems_id = %d" % self._ems_id)
+        hours   = dict(zip(cached['flight_record'].astype(int), cached['hours'].astype(float)))
+        missing = sorted(set(f for f in flights if f not in hours))
+
+        if len(missing) > 0:
+            p = self.__duration_param()
+            q = {
+                "select": [{"analyticId": p["id"]}],
+                "size": 1
+            }
+
+            def fetch(flight):
+                resp_h, content = self._conn.request( rtype = "POST", uri_keys = ("analytic", "query"),
+                                                      uri_args = (self._ems_id, flight),
+                                                      jsondata = q, idempotent = True)
+                if 'message' in content:
+                    sys.exit('API query for flight %d, parameter = "%s" was unsuccessful.\nHere is the message from API: %s' % (flight, p['name'], content['message']))
+                return content['results'][0]['values'][0]
+
+            with ThreadPoolExecutor(max_workers = min(n_workers, len(missing))) as ex:
+                new = dict(zip(missing, ex.map(fetch, missing)))
+
+            hours.update(new)
+            ld.append_data("flt_duration", pd.DataFrame({'ems_id': self._ems_id,
+                                                         'flight_record': list(new.keys()),
+                                                         'hours': list(new.values())}))
+
+        return np.array([hours[f] for f in flights], dtype = float) * factor[unit]
+
+
+    def __duration_param(self):
 
         p = self.__analytic.get_param("hours of data (hours)")
         if p["id"] == "":
             res_df = self.__analytic.search_param("hours of data (hours)", in_df = True)
             p      = res_df.iloc[0].to_dict()
-            self.__analytic._param_table = self.__analytic._param_table.append(res_df, ignore_index = True)
-            self.__analytic._save_paramtable()
-        q = {
-            "select": [{"analyticId": p["id"]}],
-            "size": 1
-        }
-
-        resp_h, content = self._conn.request( uri_keys = ("analytic", "query"),
-                                              uri_args = (self._ems_id, flight),
-                                              jsondata = q)
-        if 'message' in content:
-            sys.exit('API query for flight %d, parameter = "%s" was unsuccessful.\nHere is the message from API: %s' % (flight, p['name'], content['message']))
-        fl_len = content['results'][0]['values'][0]
-
-        if unit == "second":
-            t = fl_len * 60 * 60
-        elif unit == "minute":
-            t = fl_len * 60
-        elif unit == "hour":
-            t = fl_len
-        else:
-            sys.exit("Unrecognizable time unit (%s)." % unit)
-        return t
+            self.__analytic.add_params(res_df)
+        return p
@@ -0,0 +1,192 @@
+from __future__ import division
+from builtins import object
+from future import standard_library
+standard_library.install_aliases()
+import urllib.error
+import errno, threading, random, socket, ssl, time
+from email.utils import parsedate_tz, mktime_tz
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class RequestScheduler(object):
+	'''
+	Schedules the HTTP calls of a Connection so that parallel callers get the highest
+	throughput the API sustains without tripping its limits.
+
+	* Token bucket: at most `rate` requests per second, with bursts of up to `burst`.
+	* AIMD concurrency: the number of requests in flight grows by about one per round
+	  trip while latency stays near its baseline, and is cut on throttling, server
+	  errors or latency blowing up. Latency is tracked per endpoint (the key given to
+	  call), since metadata GETs and page reads differ by orders of magnitude, and the
+	  baseline drifts up towards the observed latency so that a slow endpoint settles
+	  instead of cutting the limit forever.
+	* Retries: throttling, server errors and network errors are retried up to
+	  `max_retries` times, honoring Retry-After and otherwise backing off exponentially
+	  with full jitter. Other errors are raised right away. Requests that are not
+	  idempotent (e.g. the POST opening an async query) are only retried when the
+	  server surely did not act on them: throttled (429/503) or never connected.
+	'''
+	retry_codes 	= (429, 500, 502, 503, 504)
+	throttle_codes 	= (429, 503)
+	# Share of the gap to the smoothed latency the baseline moves up by per call
+	baseline_drift 	= 0.05
+
+	def __init__(self, rate=None, burst=None, max_concurrency=16, min_concurrency=1, max_retries=4,
+				 backoff_base=0.5, backoff_max=60.0, latency_factor=3.0):
+
+		self.rate 			= rate
+		self.burst 			= burst if burst is not None else max(1.0, rate or 1.0)
+		self.max_concurrency = max_concurrency
+		self.min_concurrency = min_concurrency
+		self.max_retries 	= max_retries
+		self.backoff_base 	= backoff_base
+		self.backoff_max 	= backoff_max
+		self.latency_factor = latency_factor
+
+		self.limit 			= float(max_concurrency)
+		self.__active 		= 0
+		self.__tokens 		= self.burst
+		self.__stamp 		= _clock()
+		self.__paused_until = 0.0
+		# endpoint key: [baseline latency, smoothed latency]
+		self.__latency 		= dict()
+		self.__cond 		= threading.Condition()
+
+
+	def call(self, send, key=None, idempotent=True, hold=False):
+		'''
+		Runs send(), a function making one HTTP attempt, under the rate and concurrency
+		limits, and retries it on retryable errors. key identifies the endpoint for the
+		latency tracking. A send that is not idempotent is retried only if it cannot have
+		reached the server.
+
+		With hold=True, e.g. for a response whose body is read later, the slot is kept
+		after send() returns and call returns (result, release). release(record=True)
+		frees the slot, recording the latency up to then unless record is False; call it
+		once, when the body has been read or given up.
+		'''
+		attempt = 0
+		while True:
+			self.__acquire()
+			t0 = _clock()
+			try:
+				res = send()
+			except Exception as e:
+				code  = getattr(e, 'code', None)
+				retry = _is_retryable(e, self.retry_codes)
+				if retry:
+					self.__release(_clock() - t0, error=True, throttled=code in self.throttle_codes)
+				else:
+					# e.g. 404. Says nothing about the load of the server.
+					self.__release(None)
+				if retry and not idempotent:
+					retry = code in self.throttle_codes or _not_sent(e)
+				if not retry or attempt >= self.max_retries:
+					raise
+				delay = _retry_after(e)
+				if delay is not None:
+					# The server asked everyone to wait, not only this call
+					self.__pause(delay)
+				else:
+					delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+				time.sleep(delay)
+				attempt += 1
+				continue
+			if hold:
+				return res, lambda record=True: self.__release(_clock() - t0 if record else None, key=key)
+			self.__release(_clock() - t0, key=key)
+			return res
+
+
+	def stats(self):
+		'''
+		Current concurrency limit, requests in flight and latency estimates (seconds).
+		'''
+		with self.__cond:
+			return {'limit': self.limit, 'active': self.__active,
+					'latency': dict((k, v[1]) for k, v in self.__latency.items()),
+					'base_latency': dict((k, v[0]) for k, v in self.__latency.items())}
+
+
+	def __acquire(self):
+
+		with self.__cond:
+			while True:
+				now  = _clock()
+				wait = self.__paused_until - now
+				if wait <= 0 and self.__active < int(self.limit):
+					wait = self.__take_token(now)
+					if wait <= 0:
+						self.__active += 1
+						return
+				self.__cond.wait(wait if wait > 0 else None)
+
+
+	def __take_token(self, now):
+		'''Takes a token from the bucket, or returns the seconds until one is available.'''
+		if self.rate is None:
+			return 0
+		self.__tokens = min(self.burst, self.__tokens + (now - self.__stamp) * self.rate)
+		self.__stamp  = now
+		if self.__tokens >= 1:
+			self.__tokens -= 1
+			return 0
+		return (1 - self.__tokens) / self.rate
+
+
+	def __release(self, latency, error=False, throttled=False, key=None):
+		'''Frees a slot. A latency of None frees it without adjusting the limit.'''
+		with self.__cond:
+			self.__active -= 1
+			if throttled or error:
+				# Multiplicative decrease
+				self.limit = max(self.min_concurrency, self.limit / 2)
+			elif latency is not None:
+				lat = self.__latency.get(key)
+				if lat is None:
+					lat = self.__latency[key] = [latency, latency]
+				lat[1] = 0.8 * lat[1] + 0.2 * latency
+				# The baseline follows new minimums at once and drifts up slowly otherwise
+				lat[0] = min(latency, lat[0] + self.baseline_drift * (lat[1] - lat[0]))
+				if lat[1] > self.latency_factor * lat[0]:
+					self.limit = max(self.min_concurrency, self.limit * 0.9)
+				else:
+					# Additive increase of about one per round trip of the whole window
+					self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+			self.__cond.notify_all()
+
+
+	def __pause(self, delay):
+
+		with self.__cond:
+			self.__paused_until = max(self.__paused_until, _clock() + delay)
+
+
+def _is_retryable(e, codes):
+
+	if isinstance(e, urllib.error.HTTPError):
+		return e.code in codes
+	if isinstance(e, urllib.error.URLError):
+		# Connection refused/reset, DNS hiccups, timeouts. Not certificate problems.
+		return not isinstance(e.reason, ssl.CertificateError)
+	return isinstance(e, (socket.timeout, socket.error)) and not isinstance(e, ssl.CertificateError)
+
+
+def _not_sent(e):
+	'''Whether a request failed before it got to the server: connection refused.'''
+	reason = getattr(e, 'reason', e)
+	return isinstance(reason, (socket.error, OSError)) and getattr(reason, 'errno', None) == errno.ECONNREFUSED
+
+
+def _retry_after(e):
+	'''Seconds to wait from the Retry-After header of an HTTP error, if any.'''
+	headers = getattr(e, 'headers', None)
+	value = headers.get('Retry-After') if headers is not None else None
+	if value is None:
+		return None
+	try:
+		return max(0.0, float(value))
+	except ValueError:
+		date = parsedate_tz(value)
+		return None if date is None else max(0.0, mktime_tz(date) - time.time())
@@ -0,0 +1,81 @@
+from __future__ import absolute_import
+import json
+
+'''
+JSON encoding and decoding of the API requests and responses. The backend is pluggable:
+orjson is used when installed, since decoding large query results with the standard
+json module is a big share of the CPU time of an export. The standard json module is
+the fallback. ujson is available by name but not picked by default, as its float
+parsing is not always exact.
+'''
+
+def _json_loads(s):
+
+	if isinstance(s, (bytes, bytearray)):
+		s = s.decode('utf-8')
+	return json.loads(s)
+
+
+def _json_dumps(obj):
+
+	return json.dumps(obj).encode('utf-8')
+
+
+# name: (loads, dumps). loads takes bytes or str, dumps returns bytes.
+_backends = {'json': (_json_loads, _json_dumps)}
+
+try:
+	import orjson
+	_backends['orjson'] = (orjson.loads, lambda obj: orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY))
+except ImportError:
+	pass
+
+try:
+	import ujson
+	_backends['ujson'] = (ujson.loads, lambda obj: ujson.dumps(obj).encode('utf-8'))
+except ImportError:
+	pass
+
+_preference = ['orjson', 'json']
+_current = [b for b in _preference if b in _backends][0]
+
+
+def register_backend(name, loads, dumps):
+	'''
+	Adds a JSON backend. loads takes bytes (or str) and returns the decoded object,
+	dumps takes an object and returns bytes.
+	'''
+	_backends[name] = (loads, dumps)
+
+
+def set_backend(name=None):
+	'''
+	Selects the JSON backend used by default, e.g. "orjson", "ujson" or "json". None
+	picks orjson if installed, json otherwise.
+	'''
+	global _current
+	if name is None:
+		name = [b for b in _preference if b in _backends][0]
+	if name not in _backends:
+		raise ValueError("Unknown or unavailable JSON backend '%s'. Available: %s" % (name, available_backends()))
+	_current = name
+
+
+def get_backend():
+
+	return _current
+
+
+def available_backends():
+
+	return sorted(_backends)
+
+
+def loads(s, backend=None):
+	'''Decodes JSON bytes or str with the given backend, or the default one.'''
+	return _backends[backend or _current][0](s)
+
+
+def dumps(obj, backend=None):
+	'''Encodes an object to JSON bytes with the given backend, or the default one.'''
+	return _backends[backend or _current][1](obj)
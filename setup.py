@@ -13,6 +13,13 @@ setup(name = 'emspy',
       author_email = 'jimin96@gmail.com',
       license = 'MIT',
       packages = find_packages(),
-      install_requires = ['numpy', 'pandas', 'future'],
+      install_requires = ['numpy', 'pandas', 'future', 'futures; python_version < "3"'],
+      extras_require = {
+        'arrow': ['pyarrow'],
+        'ijson': ['ijson'],
+        'orjson': ['orjson'],
+        'scipy': ['scipy'],
+        'all': ['pyarrow', 'ijson', 'orjson', 'scipy']
+        },
       zip_safe = False)
       
\ No newline at end of file
@@ -0,0 +1,25 @@
+import pandas as pd
+
+from emspy.query.analytic import Analytic
+
+
+def analytic(names):
+	a = Analytic.__new__(Analytic)
+	a._param_table = pd.DataFrame({'ems_id': 1, 'id': ['p%d' % i for i in range(len(names))], 'name': names,
+								   'description': "", 'units': ""},
+								  columns = ['ems_id', 'id', 'name', 'description', 'units'])
+	a._build_index()
+	return a
+
+
+def test_empty_table_gives_empty_param():
+	a = analytic([])
+	assert a.get_param("")['id'] == ""
+	assert a.get_param("altitude")['id'] == ""
+
+
+def test_shortest_match_first():
+	a = analytic(["Pressure Altitude (ft)", "Altitude", "Airspeed"])
+	assert a.get_param("ALTITUDE")['id'] == "p1"
+	assert [p['id'] for p in a.get_param("a", unique = False)] == ["p2", "p1", "p0"]
+	assert a.get_param("flaps")['id'] == ""
@@ -0,0 +1,66 @@
+import gzip, io
+
+from emspy.connection import Connection, _BodyStream
+
+
+class Response(object):
+	'''Response of Python 2 urllib2: read and close only, no tell or seek.'''
+
+	def __init__(self, body):
+		self.__body = io.BytesIO(body)
+		self.closed = False
+
+	def read(self, n=-1):
+		return self.__body.read(n)
+
+	def close(self):
+		self.closed = True
+
+
+def gzipped(body):
+	buf = io.BytesIO()
+	with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+		f.write(body)
+	return buf.getvalue()
+
+
+def test_gzip_stream_without_tell(monkeypatch):
+	monkeypatch.setattr(Connection, 'chunk_size', 7)
+	body = b'{"rows": [' + b', '.join(b'[%d, "x"]' % i for i in range(1000)) + b']}'
+
+	stream = _BodyStream(Response(gzipped(body)), True)
+	assert stream.read() == body
+
+	# Reads of any size add up to the body
+	stream = _BodyStream(Response(gzipped(body)), True)
+	parts = []
+	while True:
+		part = stream.read(100)
+		if not part:
+			break
+		assert len(parts) == 0 or len(parts[-1]) == 100
+		parts.append(part)
+	assert b''.join(parts) == body
+
+
+def test_plain_stream():
+	resp = Response(b'{"a": 1}')
+	stream = _BodyStream(resp, False)
+	assert stream.read(3) + stream.read() == b'{"a": 1}'
+	assert stream.read() == b''
+	stream.close()
+	assert resp.closed
+
+
+def test_stream_releases_once():
+	released = []
+	stream = _BodyStream(Response(gzipped(b'{"a": 1}')), True, released.append)
+	stream.read()
+	stream.close()
+	assert released == [True]
+
+	released = []
+	stream = _BodyStream(Response(b'{"a": 1}'), False, released.append)
+	stream.read(2)
+	stream.close()
+	assert released == [False]
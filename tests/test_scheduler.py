@@ -0,0 +1,106 @@
+import emspy.scheduler as scheduler
+from emspy.scheduler import RequestScheduler
+
+
+class FakeClock(object):
+
+	def __init__(self):
+		self.now = 0.0
+
+	def __call__(self):
+		return self.now
+
+	def call(self, seconds):
+		def send():
+			self.now += seconds
+			return seconds
+		return send
+
+
+def test_mixed_latencies_keep_concurrency(monkeypatch):
+	clock = FakeClock()
+	monkeypatch.setattr(scheduler, '_clock', clock)
+	s = RequestScheduler(max_concurrency=16)
+
+	# One fast call, then many slower ones on the same endpoint
+	s.call(clock.call(0.01))
+	for i in range(30):
+		s.call(clock.call(0.05))
+	assert s.stats()['limit'] > 8
+
+	# Fast metadata calls and slow page reads interleaved on their own endpoints
+	for i in range(50):
+		s.call(clock.call(0.01), key=('fleet', 'list'))
+		s.call(clock.call(2.0), key=('database', 'get_asyncq'))
+	assert s.stats()['limit'] == 16
+
+
+def test_errors_cut_concurrency(monkeypatch):
+	clock = FakeClock()
+	monkeypatch.setattr(scheduler, '_clock', clock)
+	s = RequestScheduler(max_concurrency=16, max_retries=0)
+
+	def fail():
+		raise IOError("connection reset")
+	for i in range(3):
+		try:
+			s.call(fail)
+		except IOError:
+			pass
+	assert s.stats()['limit'] == 2
+
+
+def _http_error(code):
+	from future.moves.urllib.error import HTTPError
+	return HTTPError('http://ems/api', code, 'error', {}, None)
+
+
+def test_non_idempotent_retried_only_when_not_acted_on(monkeypatch):
+	monkeypatch.setattr(scheduler.time, 'sleep', lambda s: None)
+	s = RequestScheduler(max_retries=4)
+
+	for code, sent in ((500, 1), (502, 1), (503, 5), (429, 5)):
+		calls = []
+		def send():
+			calls.append(1)
+			raise _http_error(code)
+		try:
+			s.call(send, idempotent=False)
+		except Exception:
+			pass
+		assert len(calls) == sent
+
+	calls = []
+	def send():
+		calls.append(1)
+		raise _http_error(500)
+	try:
+		s.call(send)
+	except Exception:
+		pass
+	assert len(calls) == 5
+
+
+def test_held_slot_until_released(monkeypatch):
+	clock = FakeClock()
+	monkeypatch.setattr(scheduler, '_clock', clock)
+	s = RequestScheduler(max_concurrency=16)
+
+	res, release = s.call(clock.call(0.01), key='page', hold=True)
+	assert s.stats()['active'] == 1
+	clock.now += 2.0
+	release()
+	assert s.stats()['active'] == 0
+	assert s.stats()['latency']['page'] > 2.0
+
+
+def test_failed_call_records_no_latency():
+	s = RequestScheduler(max_concurrency=16)
+
+	def send():
+		raise _http_error(404)
+	try:
+		s.call(send)
+	except Exception:
+		pass
+	assert s.stats() == {'limit': 16, 'active': 0, 'latency': {}, 'base_latency': {}}